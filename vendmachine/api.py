@@ -4,15 +4,23 @@
 
 """
 
-from flask import Blueprint, request, jsonify, abort, make_response, url_for
+from flask import Blueprint, Response, request, abort, make_response, url_for, stream_with_context, g
+from flask_login import current_user
 import json
+import time
+import calendar
 import functools
 
+from vendmachine import codec, metrics
+from vendmachine.instrument import instrument
+from vendmachine.schema import Schema
+from vendmachine.vendqueue import QueueFull
 from vendmachine.server import server, Status
 from vendmachine.config import config
-from vendmachine.auth import ext_read_access, ext_write_access, ext_admin_access
+from vendmachine.auth import ext_read_access, ext_write_access, ext_admin_access, dump_policy, apikey_arg
 
 api = Blueprint("api", __name__)
+instrument(api)
 
 def onRegister(setup_state):
 	"""Handles the registration of an API Blueprint.
@@ -28,6 +36,78 @@ def onRegister(setup_state):
 
 api.record(onRegister)
 
+def conditional(version):
+	"""Decorator adding ETag and Last-Modified headers to GET responses.
+
+	`version()` returns a tag that changes along with the response, and the
+	time it last changed (see `vendmachine.items.Items.version()`). If the
+	request's `If-None-Match` (or `If-Modified-Since`) shows the client already
+	has the current response, `304 Not Modified` is returned without calling
+	the route.
+
+	ETags are weak, as the same tag is used for gzipped and plain bodies (see
+	`encoded()`). Last-Modified has one second resolution, so it's only sent
+	once the last change is a second old; until then another change could
+	happen with the same Last-Modified.
+	"""
+	def decorator(func):
+		@functools.wraps(func)
+		def decorated(*args, **kwargs):
+			if request.method not in ('GET', 'HEAD'): #called from another route
+				return func(*args, **kwargs)
+			tag, modified = version()
+			settled = time.time() - modified >= 1 #no later change can share its second
+			modified = int(modified) #HTTP dates have one second resolution
+			if request.if_none_match:
+				fresh = request.if_none_match.contains_weak(tag)
+			elif request.if_modified_since is not None:
+				fresh = calendar.timegm(request.if_modified_since.utctimetuple()) >= modified
+			else:
+				fresh = False
+			if fresh:
+				response = make_response("", 304)
+			else:
+				response = make_response(func(*args, **kwargs))
+			response.set_etag(tag, weak=True)
+			if settled:
+				response.last_modified = modified
+			response.vary.add("Accept-Encoding") #bodies may be gzipped
+			return response
+		return decorated
+	return decorator
+
+def encoded(kind, key=None, code=200):
+	"""Respond with a JSON body pre-encoded by `vendmachine.items.Items.encoded()`.
+
+	The body is sent gzipped to clients that accept it.
+	Returns `None` if the item or channel doesn't exist.
+	"""
+	gzip = "gzip" in request.accept_encodings
+	body = server.items.encoded(kind, key, gzip)
+	if body is None:
+		return None
+	response = Response(body, code, mimetype=codec.mimetype)
+	if gzip:
+		response.headers["Content-Encoding"] = "gzip"
+	response.vary.add("Accept-Encoding")
+	return response
+
+def jsonify(obj):
+	"""Make a response with `obj` encoded by `vendmachine.codec`, in place of `flask.jsonify()`."""
+	return Response(codec.dumps(obj), mimetype=codec.mimetype)
+
+def server_version():
+	return server.version()
+
+def items_version():
+	return server.items.version("items")
+
+def channels_version():
+	return server.items.version("channels")
+
+def catalog_version():
+	return server.items.version("items", "channels")
+
 @api.route("/", methods=['GET'])
 @ext_read_access
 def api_root():
@@ -41,17 +121,30 @@ def api_root():
 		"/refresh": ['GET'],
 		"/credit": ['GET', 'PUT', 'PATCH'],
 		"/items": ['GET', 'POST'],
+		"/items/batch": ['POST'],
 		"/items/<string:name>": ['GET', 'PUT', 'PATCH', 'DELETE'],
 		"/items/<string:name>/price": ['GET'],
+		"/items/<string:name>/channels": ['GET'],
 		"/channels": ['GET', 'POST'],
+		"/channels/batch": ['POST'],
 		"/channels/<int:channel>": ['GET', 'PUT', 'PATCH', 'DELETE'],
 		"/channels/<int:channel>/price": ['GET'],
 		"/channels/<int:channel>/vend": ['POST'],
+		"/catalog": ['GET'],
+		"/export": ['GET'],
+		"/import": ['POST'],
+		"/motors/<int:motor>": ['GET'],
 		"/vend": ['POST'],
+		"/vend/<string:ticket>": ['GET', 'DELETE'],
+		"/sales": ['GET'],
+		"/policy": ['GET'],
+		"/metrics": ['GET'],
+		"/clients": ['GET'],
 	})
 
 @api.route("/status", methods=['GET'])
 @ext_read_access
+@conditional(server_version)
 def status(code=200):
 	"""Return the machine status, as defined in `Server.status_data()`.
 
@@ -66,16 +159,18 @@ def refresh():
 
 	Requires admin access.
 	"""
-	socketio.emit('refresh')
+	server.emit('refresh')
 	return status()
 
 @api.route("/credit", methods=['GET'])
 @ext_read_access
+@conditional(server_version)
 def get_credit():
 	return jsonify({"credit": server.credit()}), 200
 
 @api.route("/credit", methods=['PUT'])
 @ext_write_access
+@body({"amount": float}, required=["amount"])
 def set_credit():
 	amount = try_arg(request, 'amount', float)
 	server.set_credit(amount)
@@ -83,6 +178,7 @@ def set_credit():
 
 @api.route("/credit", methods=['PATCH'])
 @ext_write_access
+@body({"amount": float}, required=["amount"])
 def add_credit():
 	amount = try_arg(request, 'amount', float)
 	server.add_credit(amount)
@@ -90,46 +186,93 @@ def add_credit():
 
 @api.route("/items", methods=['GET'])
 @ext_read_access
+@conditional(items_version)
 def get_items():
-	return jsonify({"items": server.items.items()})
+	"""Return items, optionally a page at a time.
+
+	`after`, `limit`: Return up to `limit` items named after `after` (the `next`
+	cursor returned with the previous page).    
+	`fields`: Comma-separated attributes to include for each item.    
+	`min_price`, `max_price`: Only return items in this price range.    
+	Any other argument only returns items having that value for that attribute.
+
+	Requires read access.
+	"""
+	args = without_apikey(request.args.to_dict())
+	if not args:
+		return encoded("items")
+	query = page_args(args)
+	for arg in ("min_price", "max_price"):
+		query[arg] = pop_arg(args, arg, float)
+	items, cursor = server.items.query_items(attrs=args, **query)
+	return jsonify({"items": items, "next": cursor})
 
 @api.route("/items", methods=['POST'])
 @ext_write_access
+@body({"name": str, "price": float}, required=["name", "price"], extra=True)
 def add_item():
-	if not request.values:
-		error("Missing arguments")
 	name = try_arg(request, 'name', str)
 	headers = {'Location': url_for("api.get_item", name=name)}
 	try:
 		if name in server.items.items(): #item already exists
 			return jsonify({"item": server.items.get_item(name)}), 400, headers
 		else:
-			price = try_arg(request, 'price', float)
-			server.items.add_item(**request.values)
+			server.items.add_item(**values(request))
 	except ValueError as e:
 		error(str(e))
 	return jsonify({"item": server.items.get_item(name)}), 201, headers
 
+@api.route("/items/batch", methods=['POST'])
+@ext_write_access
+def batch_items():
+	"""Apply a JSON array of item operations all together, or not at all.
+
+	Each operation is an object with an `op` (`add`, `replace`, `update`, or `delete`),
+	the item `name`, and any item properties. Changes are saved once.
+	Returns a result for each operation, with status 400 if any failed.
+	"""
+	return batch(item_op)
+
+def item_op(op):
+	name = str(op.pop("name"))
+	kind = op.pop("op")
+	if kind == "delete":
+		server.items.del_item(name)
+		return {"name": name, "status": 204}
+	code = 200
+	if kind == "update" and name in server.items.items():
+		server.items.update_item(name, **op)
+	elif kind in ("add", "replace", "update"):
+		if "price" not in op:
+			raise ValueError("Missing 'price'")
+		if kind == "add" or name not in server.items.items():
+			server.items.add_item(name, **op)
+			code = 201
+		else:
+			server.items.replace_item(name, **op)
+	else:
+		raise ValueError("Unknown operation '{}'".format(kind))
+	return {"name": name, "status": code, "item": dict(server.items.get_item(name))}
+
 @api.route("/items/<string:name>", methods=['GET'])
 @ext_read_access
+@conditional(items_version)
 def get_item(name):
-	item = server.items.get_item(name)
-	if item is None:
+	response = encoded("item", name)
+	if response is None:
 		error("Item does not exist")
-	return jsonify({"item": item}), 200
+	return response
 
 @api.route("/items/<string:name>", methods=['PUT'])
 @ext_write_access
+@body({"price": float}, required=["price"], extra=True)
 def replace_item(name):
-	if not request.values:
-		error("Missing arguments")
 	try:
-		price = try_arg(request, 'price', float)
 		if name in server.items.items():
-			server.items.replace_item(name, **request.values)
+			server.items.replace_item(name, **values(request))
 			code = 200
 		else:
-			server.items.add_item(name, **request.values)
+			server.items.add_item(name, **values(request))
 			code = 201
 	except ValueError as e:
 		error(str(e))
@@ -137,16 +280,17 @@ def replace_item(name):
 
 @api.route("/items/<string:name>", methods=['PATCH'])
 @ext_write_access
+@body({"price": float}, extra=True)
 def update_item(name):
-	if not request.values:
+	if not values(request):
 		error("Missing arguments")
 	try:
 		if name in server.items.items():
-			server.items.update_item(name, **request.values)
+			server.items.update_item(name, **values(request))
 			code = 200
 		else:
-			price = try_arg(request, 'price', float)
-			server.items.add_item(name, **request.values)
+			try_arg(request, 'price', float)
+			server.items.add_item(name, **values(request))
 			code = 201
 	except ValueError as e:
 		error(str(e))
@@ -165,6 +309,7 @@ def delete_item(name):
 
 @api.route("/items/<string:name>/price", methods=['GET'])
 @ext_read_access
+@conditional(items_version)
 def get_item_price(name):
 	item = server.items.get_item(name)
 	if item is None:
@@ -172,74 +317,138 @@ def get_item_price(name):
 	price = item['price']
 	return jsonify({"price": price, "text": "${:,.2f}".format(price)})
 
+@api.route("/items/<string:name>/channels", methods=['GET'])
+@ext_read_access
+@conditional(catalog_version) #404 depends on the item
+def get_item_channels(name):
+	if server.items.get_item(name) is None:
+		error("Item does not exist", 404)
+	return jsonify({"channels": server.items.channels_for_item(name)})
+
 @api.route("/channels", methods=['GET'])
 @ext_read_access
+@conditional(catalog_version) #filtered by item prices
 def get_channels():
-	return jsonify({"channels": server.items.channels()})
+	"""Return channels, optionally a page at a time.
+
+	`after`, `limit`: Return up to `limit` channels numbered after `after` (the `next`
+	cursor returned with the previous page).    
+	`fields`: Comma-separated fields (`item`, `motor`, `qty`) to include for each channel.    
+	`item`, `motor`: Only return channels holding this item, or driven by this motor.    
+	`min_price`, `max_price`: Only return channels whose item is in this price range.    
+	`min_qty`: Only return channels holding at least this many.
+
+	Requires read access.
+	"""
+	args = without_apikey(request.args.to_dict())
+	if not args:
+		return encoded("channels")
+	query = page_args(args, int)
+	query["item"] = args.pop("item", None)
+	for (arg, typ) in (("motor", int), ("min_price", float), ("max_price", float), ("min_qty", int)):
+		query[arg] = pop_arg(args, arg, typ)
+	if args:
+		error("Unknown argument '{}'".format(next(iter(args))))
+	channels, cursor = server.items.query_channels(**query)
+	return jsonify({"channels": channels, "next": cursor})
 
 @api.route("/channels", methods=['POST'])
 @ext_write_access
+@body({"channel": int, "motor": int, "item": str, "qty": int}, required=["channel", "motor", "item"])
 def add_channel():
-	if not request.values:
-		error("Missing arguments")
 	channel = try_arg(request, "channel", int)
 	if channel < 0 or channel > 99:
 		error("Invalid channel")
 	headers = {'Location': url_for("api.get_channel", channel=channel)}
 	if channel in server.items.channels():
-		return jsonify({"channel": server.items.get_channel(channel)}), 400, headers
+		return jsonify({"channel": server.items.get_channel(channel).to_dict()}), 400, headers
 	motor = try_arg(request, "motor", int)
 	item = try_arg(request, "item")
-	qty = request.values.get("qty")
+	qty = values(request).get("qty")
 	try:
-		server.items.add_channel(channel, motor, item, qty)
+		server.items.add_channel(channel, item, motor, qty)
 	except ValueError as e:
 		error(str(e))
-	return jsonify({"channel": server.items.get_channel(channel)}), 201, headers
+	return jsonify({"channel": server.items.get_channel(channel).to_dict()}), 201, headers
+
+@api.route("/channels/batch", methods=['POST'])
+@ext_write_access
+def batch_channels():
+	"""Apply a JSON array of channel operations all together, or not at all.
+
+	Each operation is an object with an `op` (`add`, `replace`, `update`, or `delete`),
+	the `channel` number, and any of `item`, `motor`, and `qty`. Changes are saved once.
+	Returns a result for each operation, with status 400 if any failed.
+	"""
+	return batch(channel_op)
+
+def channel_op(op):
+	channel = int(op.pop("channel"))
+	kind = op.pop("op")
+	if kind == "delete":
+		server.items.del_channel(channel)
+		return {"number": channel, "status": 204}
+	code = 200
+	if kind == "update" and channel in server.items.channels():
+		server.items.update_channel(channel, motor=op.get("motor"), item=op.get("item"), qty=op.get("qty"))
+	elif kind in ("add", "replace", "update"):
+		for arg in ("item", "motor"):
+			if arg not in op:
+				raise ValueError("Missing '{}'".format(arg))
+		if kind == "add" or channel not in server.items.channels():
+			server.items.add_channel(channel, op["item"], op["motor"], op.get("qty"))
+			code = 201
+		else:
+			server.items.replace_channel(channel, op["item"], op["motor"], op.get("qty"))
+	else:
+		raise ValueError("Unknown operation '{}'".format(kind))
+	return {"number": channel, "status": code, "channel": server.items.get_channel(channel).to_dict()}
 
 @api.route("/channels/<int:channel>", methods=['GET'])
 @ext_read_access
+@conditional(channels_version)
 def get_channel(channel):
-	if channel not in server.items.channels():
+	response = encoded("channel", channel)
+	if response is None:
 		error("Channel does not exist", 404)
-	return jsonify({"channel": server.items.get_channel(channel)}), 200
+	return response
 
 @api.route("/channels/<int:channel>", methods=['PUT'])
 @ext_write_access
+@body({"motor": int, "item": str, "qty": int}, required=["motor", "item"])
 def replace_channel(channel):
-	if not request.values:
-		error("Missing arguments")
 	if channel not in server.items.channels():
 		error("Channel does not exist", 404)
 	motor = try_arg(request, "motor", int)
 	item = try_arg(request, "item")
-	qty = request.values.get("qty")
+	qty = values(request).get("qty")
 	try:
-		if name in server.items.items():
-			server.items.replace_channel(channel, motor, item, qty)
+		if channel in server.items.channels():
+			server.items.replace_channel(channel, item, motor, qty)
 			code = 200
 		else:
-			server.items.add_channel(channel, motor, item, qty)
+			server.items.add_channel(channel, item, motor, qty)
 			code = 201
 	except ValueError as e:
 		error(str(e))
-	return jsonify({"channel": server.items.get_channel(channel)}), code
+	return jsonify({"channel": server.items.get_channel(channel).to_dict()}), code
 
 @api.route("/channels/<int:channel>", methods=['PATCH'])
 @ext_write_access
+@body({"motor": int, "item": str, "qty": int})
 def update_channel(channel):
-	if not request.values:
+	if not values(request):
 		error("Missing arguments")
 	if channel not in server.items.channels():
 		error("Channel does not exist", 404)
-	motor = request.values.get("motor")
-	item = request.values.get("item")
-	qty = request.values.get("qty")
+	motor = values(request).get("motor")
+	item = values(request).get("item")
+	qty = values(request).get("qty")
 	try:
 		server.items.update_channel(channel, motor, item, qty)
 	except ValueError as e:
 		error(str(e))
-	return jsonify({"channel": server.items.get_channel(channel)}), 200
+	return jsonify({"channel": server.items.get_channel(channel).to_dict()}), 200
 
 @api.route("/channels/<int:channel>", methods=['DELETE'])
 @ext_write_access
@@ -254,39 +463,298 @@ def delete_channel(channel):
 
 @api.route("/channels/<int:channel>/price", methods=['GET'])
 @ext_read_access
+@conditional(catalog_version)
 def get_channel_price(channel):
 	if channel not in server.items.channels():
 		error("Channel does not exist", 404)
 	price = server.items.get_item(channel=channel)['price']
 	return jsonify({"price": price, "text": "${:,.2f}".format(price)})
 
+@api.route("/catalog", methods=['GET'])
+@ext_read_access
+@conditional(catalog_version)
+def get_catalog():
+	"""Return every channel with its item, price, price text, and quantity, in one document.
+
+	Clients can keep the catalog and look prices up locally, applying the
+	`catalog` events sent over the websocket as it changes
+	(see `vendmachine.server.Server._items_changed()`).
+	Requires read access.
+	"""
+	return encoded("catalog")
+
+@api.route("/motors/<int:motor>", methods=['GET'])
+@ext_read_access
+@conditional(channels_version)
+def get_motor(motor):
+	channel = server.items.channel_for_motor(motor)
+	if channel is None:
+		error("Motor not in use", 404)
+	return jsonify({"channel": channel})
+
 @api.route("/vend", methods=['POST'])
 @ext_write_access
+@body({"channel": int, "sid": str}, required=["channel"])
 def vend():
+	"""Queue a vend from `channel`, returning its ticket along with the status.
+
+	Pass the websocket session id as `sid` to get `ticket` and vend result events there.
+	It must be connected as the same user as the request.
+	Requires write access.
+	"""
 	#print("vend(), request.values={}".format(request.values))
 	channel = try_arg(request, 'channel', int)
 	if channel not in server.items.channels():
 		error("Channel does not exist")
-	try:
-		server.vend(channel)
-	except ValueError:
-		error("Insufficient credit", 402)
-	except RuntimeError:
-		error("Not ready to vend", 409) #HTTP Conflict
-	return status(202)
+	return queue_vend(channel)
 
 @api.route("/channels/<int:channel>/vend", methods=['POST'])
 @ext_write_access
+@body({"sid": str})
 def vend_fixed(channel):
 	if channel not in server.items.channels():
 		error("Channel does not exist", 404)
+	return queue_vend(channel)
+
+def queue_vend(channel):
+	sid = values(request).get("sid")
+	if sid is not None and (sid not in server.sessions or server.sessions[sid] != current_user.get_id()):
+		error("Unknown websocket session") #not one of this user's
 	try:
-		server.vend(channel)
+		ticket = server.vend(channel, sid)
 	except ValueError:
 		error("Insufficient credit", 402)
 	except RuntimeError:
 		error("Not ready to vend", 409) #HTTP Conflict
-	return status()
+	except QueueFull:
+		error("Too many vends waiting", 409)
+	data = server.status_data()
+	data["ticket"] = server.vend_queue.to_dict(ticket)
+	return jsonify(data), 202, {'Location': url_for("api.get_ticket", ticket=ticket.id)}
+
+@api.route("/vend/<string:ticket>", methods=['GET'])
+@ext_read_access
+def get_ticket(ticket):
+	"""Return the state of a vend ticket, and its place in the queue while waiting.
+
+	Finished tickets are kept for a while, then forgotten.
+	Requires read access.
+	"""
+	obj = server.vend_queue.get(ticket)
+	if obj is None:
+		error("Ticket does not exist", 404)
+	return jsonify({"ticket": server.vend_queue.to_dict(obj)})
+
+@api.route("/vend/<string:ticket>", methods=['DELETE'])
+@ext_write_access
+def cancel_ticket(ticket):
+	"""Cancel a vend ticket still waiting in the queue, refunding its price.
+
+	Requires write access.
+	"""
+	try:
+		obj = server.vend_queue.cancel(ticket)
+	except ValueError as e:
+		error(str(e), 409)
+	if obj is None:
+		error("Ticket does not exist", 404)
+	return jsonify({"ticket": server.vend_queue.to_dict(obj)})
+
+class BatchFailed(Exception):
+	"""Raised to roll back a batch with failed operations."""
+
+def batch(apply):
+	"""Run `apply` on each operation in a JSON array request body,
+	inside a single `vendmachine.items.Items.transaction()`.
+
+	Every operation is attempted so that all errors are reported,
+	but if any fail, none of the changes are kept.
+	"""
+	ops = json_body(request)
+	if not isinstance(ops, list):
+		error("Expected a JSON array of operations")
+	results = []
+	failed = False
+	try:
+		with server.items.transaction():
+			for op in ops:
+				try:
+					if not isinstance(op, dict):
+						raise ValueError("Operation must be an object")
+					results.append(apply(dict(op)))
+				except KeyError as e:
+					results.append({"status": 400, "error": "Missing {}".format(e)})
+					failed = True
+				except (ValueError, TypeError) as e:
+					results.append({"status": 400, "error": str(e)})
+					failed = True
+			if failed:
+				raise BatchFailed()
+	except BatchFailed:
+		return jsonify({"error": "Batch failed, no changes made", "results": results}), 400
+	return jsonify({"results": results}), 200
+
+@api.route("/export", methods=['GET'])
+@ext_read_access
+@conditional(catalog_version)
+def export():
+	"""Stream every item and then every channel as newline-delimited JSON.
+
+	Each line is a change record: `["item", name, {...}]` or `["channel", number, {...}]`.
+	Lines are encoded as they are sent. The output can be sent to `/import` on another machine.
+	Requires read access.
+	"""
+	def generate():
+		for record in server.items.export():
+			yield codec.dumps(record) + b"\n"
+	response = Response(stream_with_context(generate()), mimetype=ndjson_mimetype)
+	response.headers["Content-Disposition"] = "attachment; filename=items.ndjson"
+	return response
+
+@api.route("/import", methods=['POST'])
+@ext_write_access
+def import_items():
+	"""Apply newline-delimited JSON change records, as made by `/export`.
+
+	The request body is read a line at a time, and records are committed in
+	groups of `batch` (default 100). Progress is sent to websocket clients as
+	`importProgress` events after each group. On an invalid record, returns
+	status 400 with the error and the number of records already committed,
+	which are kept.
+
+	The body must be sent as `application/x-ndjson`. Any other type (like a form,
+	which is parsed for an api key before this runs, consuming the body) gets 415.
+	Requires write access.
+	"""
+	if request.mimetype != ndjson_mimetype:
+		error("Expected {} body".format(ndjson_mimetype), 415)
+	#only read the query string, reading form arguments would consume the body
+	try:
+		size = int(request.args.get('batch', 100))
+	except ValueError:
+		size = 0
+	if size < 1:
+		error("Invalid 'batch' argument")
+	count = 0
+	try:
+		for count in server.items.import_records(ndjson_records(request.stream), size):
+			print("Imported {} record(s)".format(count))
+			server.emit('importProgress', {"records": count})
+	except ValueError as e:
+		return jsonify({"error": str(e), "records": count}), 400
+	return jsonify({"records": count}), 200
+
+ndjson_mimetype = "application/x-ndjson"
+
+def ndjson_records(stream):
+	"""Yield the JSON value on each non-blank line of `stream`."""
+	for n, line in enumerate(stream, 1):
+		if not line.strip():
+			continue
+		try:
+			yield json.loads(line)
+		except ValueError:
+			raise ValueError("Line {}: invalid JSON".format(n))
+
+@api.route("/sales", methods=['GET'])
+@ext_admin_access
+def get_sales():
+	"""Return sales between `start` and `end` (UNIX times, both optional).
+
+	With `group` (`item`, `channel`, `hour`, or `outcome`), return totals
+	grouped by it instead of individual sales. Otherwise return up to
+	`limit` (default 100, at most 1000) sales, newest first.
+
+	Requires admin access.
+	"""
+	if server.sales is None:
+		error("Sales ledger disabled", 404)
+	start = default_arg(request, 'start', float)
+	end = default_arg(request, 'end', float)
+	group = default_arg(request, 'group')
+	if group is not None:
+		try:
+			return jsonify({"totals": server.sales.totals(group, start, end)})
+		except ValueError as e:
+			error(str(e))
+	limit = default_arg(request, 'limit', int, 100)
+	return jsonify({"sales": server.sales.sales(start, end, limit)})
+
+@api.route("/policy", methods=['GET'])
+@ext_admin_access
+def get_policy():
+	"""Return the role required by each route and method, as compiled by
+	`vendmachine.auth.compile_policy()`.
+
+	Requires admin access.
+	"""
+	return jsonify({"policy": dump_policy()})
+
+@api.route("/metrics", methods=['GET'])
+@ext_admin_access
+def get_metrics():
+	"""Return request, websocket, vending, and saving metrics in the Prometheus
+	text format (see `vendmachine.metrics`).
+
+	Requires admin access.
+	"""
+	return Response(metrics.render(), content_type=metrics.content_type)
+
+def body(fields, required=(), extra=False):
+	"""Decorator validating a route's arguments against a `vendmachine.schema.Schema`.
+
+	The schema is made once, when the route is defined. Arguments are read from a
+	JSON object body, or else from form and query arguments, and converted to the
+	types in `fields`. Invalid requests get an API error; valid ones can read the
+	converted arguments with `values()` (and `try_arg()`, `default_arg()`).
+	"""
+	schema = Schema(fields, required, extra)
+	def decorator(func):
+		@functools.wraps(func)
+		def decorated(*args, **kwargs):
+			try:
+				g.values = schema.validate(values(request))
+			except ValueError as e:
+				error(str(e))
+			return func(*args, **kwargs)
+		return decorated
+	return decorator
+
+def values(request):
+	"""Return the arguments of a Flask request: as validated by `body()` if the route
+	has a schema, otherwise the JSON object body if there is one, or else the form
+	and query arguments. The api key a request authenticated with is never included.
+	"""
+	if "values" in g:
+		return g.values
+	if request.is_json:
+		obj = json_body(request)
+		if not isinstance(obj, dict):
+			error("Expected a JSON object")
+		return without_apikey(obj)
+	return without_apikey(request.values.to_dict())
+
+def without_apikey(args):
+	"""Return a copy of the dict `args` without the api key argument (see `vendmachine.auth.get_user()`)."""
+	return {k: v for (k, v) in args.items() if k != apikey_arg}
+
+def json_body(request):
+	"""Decode a Flask request's JSON body with `vendmachine.codec`, or return `None` if it isn't valid JSON."""
+	try:
+		return codec.loads(request.get_data(cache=True))
+	except ValueError:
+		return None
+
+@api.route("/clients", methods=['GET'])
+@ext_admin_access
+def get_clients():
+	"""Return websocket round trip times for each connected client, with degraded
+	clients first, and the server's event loop delay (`hubDelay`), as percentiles
+	over recent heartbeats (see `vendmachine.heartbeat`).
+
+	Requires admin access.
+	"""
+	return jsonify({"clients": server.heartbeat.report(), "hubDelay": server.heartbeat.hub_delay()})
 
 def default_arg(request, arg, typ=None, default=None):
 	"""Try to find and coerce value in a Flask request,
@@ -297,15 +765,41 @@ def default_arg(request, arg, typ=None, default=None):
 	`typ`: Type to coerce to (default `None`).    
 	`default`: Default value to return on failure (default `None`).
 	"""
-	if arg not in request.values:
+	args = values(request)
+	if arg not in args:
 		return default
 	if typ is None:
-		return request.values[arg]
+		return args[arg]
 	try:
-		return typ(request.values[arg])
+		return typ(args[arg])
 	except ValueError:
 		return default
 
+def pop_arg(args, arg, typ):
+	"""Remove and coerce an optional argument from the dict `args`,
+	   returning `None` if missing or an API error if invalid.
+	"""
+	if arg not in args:
+		return None
+	try:
+		return typ(args.pop(arg))
+	except ValueError:
+		error("Invalid '{}' argument".format(arg))
+
+def page_args(args, cursor=str):
+	"""Remove the `after`, `limit`, and `fields` arguments from the dict `args`,
+	   for `vendmachine.items.Items.query_items()` or `query_channels()`.
+	"""
+	limit = pop_arg(args, "limit", int)
+	if limit is not None and limit < 1:
+		error("Invalid 'limit' argument")
+	fields = args.pop("fields", None)
+	return {
+		"after": pop_arg(args, "after", cursor),
+		"limit": limit,
+		"fields": [field for field in fields.split(",") if field] if fields is not None else None,
+	}
+
 def try_arg(request, arg, typ=None):
 	"""Try to find and coerce value in a Flask request,
 	   returning an API error if missing or invalid.
@@ -314,12 +808,13 @@ def try_arg(request, arg, typ=None):
 	`arg`: Name of argument to search for.    
 	`typ`: Type to coerce to (default `None`).
 	"""
-	if not request.values or arg not in request.values:
+	args = values(request)
+	if not args or arg not in args:
 		error("Missing '{}' argument".format(arg))
 	if typ is None:
-		return request.values[arg]
+		return args[arg]
 	try:
-		return typ(request.values[arg])
+		return typ(args[arg])
 	except ValueError:
 		error("Invalid '{}' argument".format(arg))
 
@@ -5,16 +5,23 @@
 Incomplete at the moment. Took a lot of inspiration from OctoPrint.
 """
 
+import hmac
+import math
 import functools
+import ipaddress
 
-from flask import abort, request
+from flask import abort, request, jsonify, make_response
 from flask_login import current_user, login_fresh
 
+from vendmachine import metrics
 from vendmachine.server import server
 
 from vendmachine.users import api_user, anon_user
 server.login_manager.anonymous_user = anon_user
 
+apikey_arg = "apikey"
+"""Form or query argument holding an api key, which routes never see as one of their own."""
+
 @server.login_manager.user_loader
 def load_user(uid):
 	return server.users.get(uid)
@@ -26,14 +33,15 @@ def get_user(request):
 	Looks for a valid api key in headers, post data, or query strings.
 	"""
 	apikey = None
-	if hasattr(request, "values") and "apikey" in request.values:
-		apikey = request.values["apikey"]
+	if hasattr(request, "values") and apikey_arg in request.values:
+		apikey = request.values[apikey_arg]
 	elif "X-Api-Key" in request.headers.keys():
 		apikey = request.headers.get("X-Api-Key")
 	if apikey is not None:
-		if apikey == settings().get(["access", "apikey"]): #global apikey
+		global_key = server.config.get(["access", "apikey"])
+		if global_key and hmac.compare_digest(apikey.encode(), str(global_key).encode()): #global apikey
 			return api_user
-		return server.users.find_one(apikey=apikey)
+		return server.users.find_apikey(apikey)
 	return None
 
 def is_user(request):
@@ -55,47 +63,181 @@ def is_ext(request):
 	"""Determines whether a request came from outside (/ext/)."""
 	return request.path.startswith('/ext/')
 
-def make_access_decorator(cond, doc="Validate before running a Flask route/handler."):
-	"""Generic access decorator. Provides access only if cond(request) is truthy."""
+access_levels = {
+	"user": ("user", False, None),
+	"admin": ("admin", False, None),
+	"fresh_user": ("fresh_user", False, None),
+	"fresh_admin": ("fresh_admin", False, None),
+	"ext_user": ("user", True, None),
+	"ext_admin": ("admin", True, None),
+	"ext_read": ("user", True, "restrict_read"),
+	"ext_write": ("user", True, "restrict_write"),
+	"read": ("user", False, "restrict_read"),
+}
+"""Access levels used by the decorators below.
+
+Each maps to the role it requires, whether it only applies to external
+requests (under /ext/), and the `access` setting that can lift it.
+"""
+
+level_classes = {
+	"user": "write",
+	"admin": "admin",
+	"fresh_user": "write",
+	"fresh_admin": "admin",
+	"ext_user": "write",
+	"ext_admin": "admin",
+	"ext_read": "read",
+	"ext_write": "write",
+	"read": "read",
+}
+"""Rate limit class (see `vendmachine.ratelimit`) of routes at each access level."""
+
+roles = {
+	None: lambda: True,
+	"user": lambda: current_user.is_authenticated,
+	"admin": lambda: current_user.is_admin,
+	"fresh_user": lambda: current_user.is_authenticated and login_fresh(),
+	"fresh_admin": lambda: current_user.is_admin and login_fresh(),
+}
+"""Checks for each role a route can require (`None` allows anyone)."""
+
+policy = {}
+"""Role required by each `(rule, method)`, compiled by `compile_policy()`."""
+
+def resolve_level(level, ext, restrictions):
+	"""Return the role required by access `level`.
+
+	`ext` is whether the route is external, and `restrictions` maps
+	each `access` setting (`restrict_read`, `restrict_write`) to its value.
+	"""
+	role, ext_only, restriction = access_levels[level]
+	if ext_only and not ext:
+		return None
+	if restriction is not None and not restrictions.get(restriction):
+		return None
+	return role
+
+def _restrictions():
+	return {key: bool(server.config.get(['access', key])) for key in ("restrict_read", "restrict_write")}
+
+def compile_policy(app=None):
+	"""Resolve the role required by every route and method of `app` into `policy`.
+
+	Must be called again whenever the `access` settings change.
+	"""
+	if app is None:
+		app = server.app
+	restrictions = _restrictions()
+	table = {}
+	for rule in app.url_map.iter_rules():
+		level = getattr(app.view_functions.get(rule.endpoint), "access", None)
+		if level is None:
+			continue
+		role = resolve_level(level, rule.rule.startswith('/ext/'), restrictions)
+		for method in rule.methods:
+			table[(rule.rule, method)] = role
+	policy.clear()
+	policy.update(table)
+
+def dump_policy():
+	"""Return the compiled policy as a sorted list of `{"rule", "method", "role"}`."""
+	return [{"rule": rule, "method": method, "role": role} for ((rule, method), role) in sorted(policy.items())]
+
+def client_address():
+	"""Return the address of the client making a request, as forwarded by a trusted proxy
+	(`server.trusted_proxies` in `config.yaml`) if the request came through one.
+	"""
+	addr = request.remote_addr
+	if addr in (server.config.get(["server", "trusted_proxies"]) or ()):
+		forwarded = request.headers.get("X-Forwarded-For", "").split(",")[-1].strip() #added by our proxy
+		if forwarded:
+			addr = forwarded
+	return addr
+
+def client_id():
+	"""Identify the client making a request, for rate limiting: by user (or API key) if
+	authenticated, and by address otherwise. Returns `None` for the local kiosk, which
+	isn't limited.
+	"""
+	if current_user.is_authenticated:
+		return "user:{}".format(current_user.get_id())
+	addr = client_address()
+	try:
+		if ipaddress.ip_address(addr).is_loopback:
+			return None
+	except ValueError: #not an IP address (e.g. a unix socket)
+		pass
+	return "addr:{}".format(addr)
+
+def throttle(level):
+	"""Refuse the request with `429 Too Many Requests` if its client is over the
+	rate limit for routes at access `level`."""
+	if server.limiter is None:
+		return
+	client = client_id()
+	if client is None:
+		return
+	cls = level_classes[level]
+	wait = server.limiter.take(cls, client)
+	if wait:
+		metrics.throttled.inc(cls)
+		response = make_response(jsonify({"error": "Too many requests"}), 429)
+		response.headers["Retry-After"] = str(math.ceil(wait))
+		abort(response)
+
+def make_access_decorator(level, doc="Validate before running a Flask route/handler."):
+	"""Generic access decorator. Provides access only to users with the role required by `level`.
+
+	The role is looked up in `policy`, falling back to resolving `level` directly
+	for routes that haven't been compiled. Requests are rate limited first (see `throttle()`).
+	"""
 	def decorator(func):
 		@functools.wraps(func)
 		def decorated(*args, **kwargs):
 			if request.method == "OPTIONS": #OPTIONS requests exempt from login
 				return func(*args, **kwargs)
-			if cond(request): #cond supplied to make_access_decorator
+			throttle(level)
+			rule = request.url_rule
+			try:
+				role = policy[(rule.rule, request.method)]
+			except (KeyError, AttributeError): #not compiled
+				role = resolve_level(level, is_ext(request), _restrictions())
+			if roles[role](): #role required by level supplied to make_access_decorator
 				return func(*args, **kwargs)
 			return server.login_manager.unauthorized()
+		decorated.access = level
 		return decorated
 	decorator.__doc__ = doc
 	return decorator
 
-user_access = make_access_decorator(lambda r: current_user.is_authenticated, """
+user_access = make_access_decorator("user", """
 Validate a user before running a Flask route/handler.
 
 Used as a decorator.""")
 
-admin_access = make_access_decorator(lambda r: current_user.is_admin, """
+admin_access = make_access_decorator("admin", """
 Validate an admin before running a Flask route/handler.
 
 Used as a decorator.""")
 
-fresh_user_access = make_access_decorator(lambda r: current_user.is_authenticated and login_fresh(),
+fresh_user_access = make_access_decorator("fresh_user",
 """Validate a user, requiring a fresh login.""")
 
-fresh_admin_access = make_access_decorator(lambda r: current_user.is_admin and login_fresh(),
+fresh_admin_access = make_access_decorator("fresh_admin",
 """Validate an admin, requiring a fresh login.""")
 
-ext_user_access = make_access_decorator(lambda r: not is_ext(r) or current_user.is_authenticated, """
+ext_user_access = make_access_decorator("ext_user", """
 Validate a user if request happened from outside (/ext/).""")
 
-ext_admin_access = make_access_decorator(lambda r: not is_ext(r) or current_user.is_admin, """
+ext_admin_access = make_access_decorator("ext_admin", """
 Validate an admin if request happened from outside (/ext/).""")
 
-ext_read_access = make_access_decorator(lambda r: not is_ext(r) or current_user.is_authenticated or not server.config.get(['access', 'restrict_read']), """
+ext_read_access = make_access_decorator("ext_read", """
 Validate that an external client is allowed to read APIs. This requires authentication if set in configuration.""")
 
-ext_write_access = make_access_decorator(lambda r: not is_ext(r) or current_user.is_authenticated or not server.config.get(['access', 'restrict_write']), """
+ext_write_access = make_access_decorator("ext_write", """
 Validate that an external client is allowed to write to APIs. This requires authentication if set in configuration.""")
 
-read_access = make_access_decorator(lambda r: current_user.is_authenticated or not server.config.get(['access', 'restrict_read']), """
+read_access = make_access_decorator("read", """
 Validate that a client is allowed to view pages. This requires authentication if set in configuration.""")
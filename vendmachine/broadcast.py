@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+"""Sends machine status changes to websocket clients.
+
+Status can change many times in quick succession (one credit pulse per
+dollar of a bill), so changes are coalesced: the first change starts a
+short window, and at its end a single `status` event goes to every
+client, holding only the fields that changed since the last one.
+
+Every broadcast has a sequence number `seq`, increased by one each time.
+A client that misses one (its last `seq` isn't one less) should ask for
+the full status by sending a `status` event, which is answered to that
+client alone with `StatusBroadcaster.snapshot()`.
+
+`seq` starts over from 0 when the server restarts. Broadcasts and
+snapshots are sent with the `epoch` of `vendmachine.events.EventLog`,
+and a client should drop its `seq` when that changes.
+"""
+
+import eventlet
+
+class StatusBroadcaster():
+	def __init__(self, server, window=0.05):
+		self._server = server
+		self.window = window #seconds to gather changes before sending them
+		self.seq = 0
+		self._sent = server.status_data()["status"] #status fields as last sent
+		self._timer = None
+
+	def notify(self):
+		"""Schedule a broadcast of whatever has changed, once the window ends."""
+		if self._timer is None:
+			self._timer = eventlet.spawn_after(self.window, self.flush)
+
+	def flush(self):
+		"""Immediately send any changes to all clients."""
+		timer, self._timer = self._timer, None
+		if timer is not None and timer is not eventlet.getcurrent():
+			timer.cancel()
+		status = self._server.status_data()["status"]
+		changed = {k: v for (k, v) in status.items() if self._sent.get(k) != v}
+		if not changed:
+			return
+		self._sent = status
+		self.seq += 1
+		print("status {}, credit={}".format(status["text"], status["credit"]))
+		self._server.emit('status', {"status": changed, "seq": self.seq, "partial": True})
+
+	def snapshot(self):
+		"""Return the full status, for a client which asked for it.
+
+		Its `seq` is that of the last broadcast, so following broadcasts apply on top of it.
+		"""
+		return {"status": self._server.status_data()["status"], "seq": self.seq, "partial": False}
+
+	def stop(self):
+		if self._timer is not None:
+			self._timer.cancel()
+			self._timer = None
@@ -1,20 +1,34 @@
 #!/usr/bin/env python3
 
 import os
+import copy
 import yaml
-import collections
+import collections.abc
+
+from vendmachine.persist import load_yaml, save_yaml
 
 config = None #held globally so it can be accessed outside a Server
 
 default_config = {
 	"server": {
 		"host": "127.0.0.1",
-		"port": 5000
+		"port": 5000,
+		"status_window": 0.05, #seconds to gather status changes before sending them to clients
+		"event_buffer": 100, #recent events kept per topic, for clients resuming after reconnecting
+		"heartbeat_interval": 5.0, #seconds between latency checks of each websocket client
+		"vend_queue": 10, #most vends waiting at once
+		"heartbeat_degraded": 0.5, #round trip time (90th percentile, in seconds) above which a client is degraded
+		"trusted_proxies": ["127.0.0.1", "::1"], #addresses of proxies (haproxy) whose X-Forwarded-For is believed
 	},
 	"access": {
 		"restrict_read": True,
 		"restrict_write": True,
 	},
+	"ratelimit": { #requests per second allowed from each client, by kind of route (rate 0 for no limit)
+		"read": {"rate": 20.0, "burst": 40},
+		"write": {"rate": 5.0, "burst": 10},
+		"admin": {"rate": 2.0, "burst": 10},
+	},
 	"appearance": {
 	},
 	"logging": {
@@ -24,50 +38,77 @@ default_config = {
 	"files": {
 		"items": "items.yaml",
 		"users": "users.yaml",
+		"backend": "yaml", #'yaml' to use the files above, or 'sqlite' to use database below
+		"database": "vend.db",
+		"sales": "sales.db", #ledger of every vend, or empty to disable
 		"autosave": True,
+		"cache": True, #keep binary snapshots of items and users files for faster startup
+		"journal": False, #append changes to items to a journal instead of rewriting items file
+		"compact": 100, #journal records kept before rewriting items file
+		"background": True, #save changes from a background thread
+		"flush_delay": 1.0, #seconds without changes before saving
+		"flush_max_delay": 10.0, #longest to hold unsaved changes
+		"watch": True, #reload items file and this file when they are edited
+		"watch_interval": 2.0, #seconds between checks for edits, when inotify is unavailable
 	}
 }
 
 def recursive_update(old, new):
 	for k, v in new.items():
-		if isinstance(v, collections.Mapping):
+		if isinstance(v, collections.abc.Mapping):
 			old[k] = recursive_update(old.get(k, {}), v)
 		else:
 			old[k] = v
 	return old
 
+def flatten(node, prefix=(), flat=None):
+	"""Map the key tuple of every value (and every nested mapping) in `node` to that value."""
+	if flat is None:
+		flat = {}
+	for k, v in node.items():
+		keys = prefix + (k,)
+		flat[keys] = v
+		if isinstance(v, collections.abc.Mapping):
+			flatten(v, keys, flat)
+	return flat
+
 class Config():
+	"""Server settings, loaded from `config.yaml` on top of `default_config`.
+
+	Settings are read with a list of keys (e.g. `config.get(["server", "port"])`),
+	which is looked up directly in a flattened copy of the settings.
+	`Config.version` increases on every change, and callbacks registered with
+	`Config.subscribe()` are called on every `Config.set()` or `Config.reload()`.
+	"""
 	def __init__(self, config_dir=""):
 		self._config_file = os.path.join(config_dir, "config.yaml")
+		self._dirty = False
+		self.flusher = None #`vendmachine.persist.Flusher` to save in the background, if any
+		self.version = 0
+		self._subscribers = []
+		self._watcher = None
 
-		self._config = default_config #not a deep copy - be careful
 		if os.path.exists(self._config_file) and os.path.isfile(self._config_file):
 			print("Loading config")
-			with open(self._config_file, "r") as f:
-				try:
-					new_config = yaml.safe_load(f)
-					#self._mtime = self.last_modified
-				except yaml.YAMLError as e:
-					print("Invalid YAML File: {}".format(self._config_file))
-					print("details: {}".format(e))
-					raise
-				recursive_update(self._config, new_config)
-				#self._config.update(new_config)
+			self._config = self._read()
 		else:
 			print("Writing default setings")
-			with open(self._config_file, "w") as f:
-				yaml.safe_dump(default_config, f)
-	def get(self, keys):
+			self._config = copy.deepcopy(default_config)
+			save_yaml(self._config_file, default_config)
+		self._flat = flatten(self._config)
+	def _read(self):
 		try:
-			if hasattr(keys, "index") and not hasattr(keys, "split"):
-				node = self._config
-				for key in keys:
-					node = node[key]
-				return node
-			else: #treat as scalar
-				return self._config[keys]
-		except:
-			return None
+			new_config = load_yaml(self._config_file)
+		except yaml.YAMLError as e:
+			print("Invalid YAML File: {}".format(self._config_file))
+			print("details: {}".format(e))
+			raise
+		return recursive_update(copy.deepcopy(default_config), new_config or {})
+	def get(self, keys):
+		if hasattr(keys, "index") and not hasattr(keys, "split"):
+			return self._flat.get(tuple(keys))
+		else: #treat as scalar
+			return self._flat.get((keys,))
 	def set(self, keys, val):
 		if hasattr(keys, "index") and not hasattr(keys, "split"):
 			if len(keys) == 0:
@@ -78,12 +119,60 @@ class Config():
 					node[key] = {}
 				node = node[key]
 			node[keys[-1]] = val
+			keys = tuple(keys)
 		else: #treat as scalar
 			self._config[keys] = val
+			keys = (keys,)
+		self._changed(keys)
+	def _changed(self, keys):
+		self._flat = flatten(self._config)
+		self.version += 1
+		for (callback, prefix) in self._subscribers:
+			if keys is None or keys[:len(prefix)] == prefix or prefix[:len(keys)] == keys:
+				try:
+					callback(self, keys)
+				except Exception as e: #the rest still need to hear of the change
+					print("Error handling config change: {}".format(e))
+	def subscribe(self, callback, prefix=()):
+		"""Call `callback(config, keys)` whenever a setting under `prefix` changes.
+
+		`keys` is the tuple of keys that was set, or `None` if the whole file was reloaded.
+		"""
+		self._subscribers.append((callback, tuple(prefix)))
+	def reload(self):
+		"""Re-read `config.yaml`, notifying subscribers if anything changed."""
+		new_config = self._read()
+		if new_config == self._config: #probably our own save
+			return False
+		print("Reloaded config")
+		self._config = new_config
+		self._changed(None)
+		return True
+	def watch(self, interval=2.0):
+		"""Reload `config.yaml` whenever it is edited."""
+		if self._watcher is None:
+			from vendmachine.watch import FileWatcher
+			self._watcher = FileWatcher(self._config_file, self.reload, interval)
+			self._watcher.start()
+	def unwatch(self):
+		if self._watcher is not None:
+			self._watcher.stop()
+			self._watcher = None
+	def dirty(self):
+		self._dirty = True
+		if not self.get(["files", "autosave"]):
+			return
+		if self.flusher is not None:
+			self.flusher.notify(self)
+		else:
+			self.save()
+	def flush(self):
+		if self._dirty:
+			self.save()
 	def save(self):
 		print("Saving configuration")
-		with open(self._config_file, "w") as f:
-			yaml.safe_dump(self._config, f)
+		save_yaml(self._config_file, self._config)
+		self._dirty = False
 
 def init(config_dir=None):
 	global config
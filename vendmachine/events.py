@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+"""Topics websocket clients subscribe to, and the events sent under each.
+
+Each topic is a socket.io room. Clients join the `default_topics` when
+they connect, and can `subscribe`/`unsubscribe` to others. Events are
+only sent to the room of their topic, so a dashboard not following the
+catalog is never sent catalog changes, and so on.
+
+Results of a vend go to the websocket session that asked for it, when
+known, and to the `vend` topic otherwise. Events without a topic (like
+`refresh` and `shutdown`) go to every client.
+
+Events sent to a topic are numbered (`eventSeq`) and the most recent of
+each topic are kept in an `EventLog`, so a client that reconnects can
+`resume` from the last number it saw and be sent only what it missed.
+Numbering starts over when the server restarts, so events also carry the
+`epoch` they were numbered in; a client seeing a new one should forget
+the numbers it has (including the status `seq`, see `vendmachine.broadcast`).
+"""
+
+import secrets
+import collections
+import itertools
+
+topics = {
+	"status": "Machine status and credit.",
+	"catalog": "Changes to items and channels.",
+	"vend": "Results of vends not requested by a websocket session.",
+	"admin": "Maintenance events, like import progress. Admins only.",
+}
+"""Topics clients can subscribe to, and what they carry."""
+
+default_topics = ("status", "catalog")
+"""Topics every client joins when it connects."""
+
+admin_topics = frozenset(["admin"])
+"""Topics only admins can subscribe to."""
+
+event_topics = {
+	"status": "status",
+	"catalog": "catalog",
+	"itemUpdate": "catalog",
+	"itemDelete": "catalog",
+	"channelUpdate": "catalog",
+	"channelDelete": "catalog",
+	"vendSuccess": "vend",
+	"vendError": "vend",
+	"ticket": "vend",
+	"importProgress": "admin",
+}
+"""Topic of each event sent by the server. Events not listed go to every client."""
+
+def topic(event):
+	"""Return the topic `event` is sent under, or `None` if it goes to every client."""
+	return event_topics.get(event)
+
+class EventLog():
+	"""The most recent `size` events sent to each topic, numbered in the order sent."""
+	def __init__(self, size=100):
+		self.size = size
+		self.epoch = secrets.token_hex(4) #distinguishes numbers from before a restart
+		self.seq = 0 #number of the last event sent
+		self._events = {} #deque of `(seq, event, data)` by topic
+		self._dropped = {} #number of the last event no longer kept, by topic
+
+	def record(self, topic, event, data):
+		"""Number an event sent to `topic`, keeping it for replay. Returns its number."""
+		self.seq += 1
+		events = self._events.get(topic)
+		if events is None:
+			events = self._events[topic] = collections.deque(maxlen=self.size)
+		elif len(events) == events.maxlen:
+			self._dropped[topic] = events[0][0]
+		events.append((self.seq, event, data))
+		return self.seq
+
+	def since(self, topics, seq, epoch=None):
+		"""Return the `(seq, event, data)` of every event sent to `topics` after `seq`, in order.
+
+		Topics for which events after `seq` are no longer kept (or `seq` is from
+		another `epoch`, before a restart) are left out, and returned separately
+		as a set of topics needing a snapshot instead.
+		"""
+		missed = []
+		stale = set()
+		for topic in topics:
+			if epoch != self.epoch or seq > self.seq or self._dropped.get(topic, 0) > seq:
+				stale.add(topic)
+				continue
+			events = self._events.get(topic, ())
+			missed.extend(itertools.dropwhile(lambda e: e[0] <= seq, events))
+		missed.sort(key=lambda e: e[0])
+		return missed, stale
@@ -15,11 +15,13 @@ from flask import Blueprint, request, abort, redirect
 from flask import make_response, render_template, url_for
 from flask_login import login_user, logout_user, current_user
 
+from vendmachine.instrument import instrument
 from vendmachine.server import server, Status
 from vendmachine.config import config
 from vendmachine.auth import user_access, admin_access, read_access
 
 ext = Blueprint("ext", __name__)
+instrument(ext)
 
 @ext.route("/")
 @read_access
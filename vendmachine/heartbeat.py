@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+"""Measures websocket latency to each connected client.
+
+Every `interval` seconds the server sends each client a `heartbeat`
+event, which the client acknowledges. For each client this records the
+round trip time of the last `window` heartbeats. Separately, for the
+server as a whole, it records how late the event loop (the eventlet hub)
+was in waking up to send them, which separates a slow network from a
+busy server.
+
+A client is flagged as degraded when its 90th percentile round trip
+time is over the `degraded` threshold, or it has missed several
+heartbeats in a row.
+"""
+
+import time
+import math
+import functools
+import collections
+import eventlet
+
+from vendmachine import metrics
+
+missed_limit = 3
+"""Heartbeats a client can miss in a row before it is flagged as degraded."""
+
+def percentile(values, p):
+	"""Return the `p`th percentile (nearest rank) of `values`, or `None` if empty."""
+	if not values:
+		return None
+	values = sorted(values)
+	return values[max(0, math.ceil(p/100*len(values)) - 1)]
+
+def summary(values):
+	return {"p50": percentile(values, 50), "p90": percentile(values, 90), "p99": percentile(values, 99)}
+
+class Client():
+	"""Latency of a single connection."""
+	__slots__ = ("address", "connected", "rtts", "pending", "missed", "lost")
+
+	def __init__(self, address, window):
+		self.address = address
+		self.connected = time.time()
+		self.rtts = collections.deque(maxlen=window) #round trip times, in seconds
+		self.pending = None #number of heartbeat awaiting acknowledgement
+		self.missed = 0 #heartbeats missed in a row
+		self.lost = 0 #heartbeats missed in total
+
+	def degraded(self, threshold):
+		p90 = percentile(self.rtts, 90)
+		return self.missed >= missed_limit or (p90 is not None and p90 > threshold)
+
+class Heartbeat():
+	def __init__(self, server, interval=5.0, degraded=0.5, window=60):
+		self._server = server
+		self.interval = interval #seconds between heartbeats
+		self.degraded = degraded #90th percentile round trip time (seconds) above which a client is degraded
+		self.window = window #heartbeats kept for percentiles
+		self._clients = {} #`Client` by websocket session id
+		self._lags = collections.deque(maxlen=window) #hub delays when sending, in seconds
+		self._seq = 0
+		self._thread = None
+
+	def add(self, sid, address):
+		self._clients[sid] = Client(address, self.window)
+
+	def remove(self, sid):
+		self._clients.pop(sid, None)
+
+	def start(self):
+		if self._thread is None:
+			self._thread = eventlet.spawn(self._run)
+
+	def stop(self):
+		if self._thread is not None:
+			self._thread.kill()
+			self._thread = None
+
+	def _run(self):
+		due = time.monotonic() + self.interval
+		while True:
+			eventlet.sleep(max(0, due - time.monotonic()))
+			now = time.monotonic()
+			lag = max(0.0, now - due) #how late the hub woke us
+			due = max(due + self.interval, now) #don't try to catch up after a stall
+			self.beat(lag)
+
+	def beat(self, lag=0.0):
+		"""Send a heartbeat to every client."""
+		self._seq += 1
+		self._lags.append(lag)
+		for (sid, client) in list(self._clients.items()):
+			if client.pending is not None: #previous heartbeat never acknowledged
+				client.missed += 1
+				client.lost += 1
+			client.pending = self._seq
+			self._server.emit('heartbeat', {"seq": self._seq}, room=sid,
+			                  callback=functools.partial(self._ack, sid, self._seq, time.monotonic()))
+
+	def _ack(self, sid, seq, sent, *args):
+		client = self._clients.get(sid)
+		if client is None or client.pending != seq: #disconnected, or too late
+			return
+		rtt = time.monotonic() - sent
+		client.pending = None
+		client.missed = 0
+		client.rtts.append(rtt)
+		metrics.heartbeat_seconds.observe(rtt)
+
+	def report(self):
+		"""Return the latency of every connected client, worst first."""
+		clients = [{
+			"sid": sid,
+			"address": client.address,
+			"connected": client.connected,
+			"samples": len(client.rtts),
+			"rtt": summary(client.rtts),
+			"missed": client.missed,
+			"lost": client.lost,
+			"degraded": client.degraded(self.degraded),
+		} for (sid, client) in self._clients.items()]
+		clients.sort(key=lambda c: (not c["degraded"], -(c["rtt"]["p90"] or 0)))
+		return clients
+
+	def hub_delay(self):
+		"""Return how late the event loop was in sending recent heartbeats.
+
+		This is one figure for the whole server, as every client's heartbeat is sent on the same beat.
+		"""
+		return summary(self._lags)
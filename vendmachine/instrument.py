@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+
+"""Counts and times the requests served by Flask blueprints (see `vendmachine.metrics`)."""
+
+import time
+
+from flask import request, g
+
+from vendmachine import metrics
+
+def instrument(blueprint):
+	"""Count requests to every route of `blueprint`, and time them."""
+	blueprint.before_request(_start_request)
+	blueprint.after_request(_end_request)
+
+def _start_request():
+	g.metrics_start = time.perf_counter()
+
+def _end_request(response):
+	start = g.get("metrics_start")
+	route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+	metrics.requests.inc(route, request.method, response.status_code)
+	if start is not None:
+		metrics.request_seconds.observe(time.perf_counter() - start, route, request.method)
+	return response
@@ -1,71 +1,353 @@
 import os
+import sys
+import copy
+import time
+import secrets
+import bisect
+import itertools
+import contextlib
+import collections.abc
 import yaml
 
+from vendmachine import codec
+from vendmachine.journal import Journal
+from vendmachine.persist import load_yaml, save_yaml, file_key
+
+class Channel():
+	"""A single channel: the item it holds, the motor that vends it, and how many are left.
+
+	Supports `channel["item"]`-style reads for code expecting a dict.
+	Use `Channel.to_dict()` to serialize.
+	"""
+	__slots__ = ("item", "motor", "qty")
+
+	def __init__(self, item, motor, qty=0):
+		self.item = sys.intern(str(item)) #shared with every other channel holding the item
+		self.motor = motor
+		self.qty = qty
+
+	@classmethod
+	def from_dict(cls, obj):
+		qty = obj.get("qty")
+		return cls(obj["item"], obj["motor"], int(qty) if qty is not None else 0) #as stored by `Items.add_channel()`
+
+	def to_dict(self):
+		return {"item": self.item, "motor": self.motor, "qty": self.qty}
+
+	def copy(self):
+		return Channel(self.item, self.motor, self.qty)
+
+	def __getitem__(self, key):
+		if key not in Channel.__slots__:
+			raise KeyError(key)
+		return getattr(self, key)
+
+	def __eq__(self, other):
+		return isinstance(other, Channel) and self.to_dict() == other.to_dict()
+
+	def __repr__(self):
+		return "Channel({!r}, {}, {})".format(self.item, self.motor, self.qty)
+
+class ChannelTable(collections.abc.MutableMapping):
+	"""Fixed table of the 100 two-digit channels, mapping channel number to `Channel`.
+
+	Iterates in channel order. Use `ChannelTable.to_dict()` to serialize.
+	"""
+	size = 100
+	__slots__ = ("_slots", "_len")
+
+	def __init__(self):
+		self._slots = [None]*ChannelTable.size
+		self._len = 0
+
+	def _check(self, channel):
+		if type(channel) is not int or channel < 0 or channel >= ChannelTable.size:
+			raise KeyError(channel)
+
+	def __getitem__(self, channel):
+		self._check(channel)
+		obj = self._slots[channel]
+		if obj is None:
+			raise KeyError(channel)
+		return obj
+
+	def __setitem__(self, channel, obj):
+		self._check(channel)
+		if self._slots[channel] is None:
+			self._len += 1
+		self._slots[channel] = obj
+
+	def __delitem__(self, channel):
+		self[channel] #raise KeyError if empty
+		self._slots[channel] = None
+		self._len -= 1
+
+	def __contains__(self, channel):
+		return type(channel) is int and 0 <= channel < ChannelTable.size and self._slots[channel] is not None
+
+	def __iter__(self):
+		return (channel for (channel, obj) in enumerate(self._slots) if obj is not None)
+
+	def __len__(self):
+		return self._len
+
+	def items(self):
+		return [(channel, obj) for (channel, obj) in enumerate(self._slots) if obj is not None]
+
+	def values(self):
+		return [obj for obj in self._slots if obj is not None]
+
+	def copy(self):
+		table = ChannelTable()
+		table._slots = [obj.copy() if obj is not None else None for obj in self._slots]
+		table._len = self._len
+		return table
+
+	def to_dict(self):
+		return {channel: obj.to_dict() for (channel, obj) in self.items()}
+
+record_resources = {
+	"item": "items",
+	"del_item": "items",
+	"channel": "channels",
+	"del_channel": "channels",
+}
+"""Resource (`items` or `channels`) changed by each kind of change record."""
+
 class Items():
-	def __init__(self, itemPath="", itemFile="items.yaml", autosave=True):
+	def __init__(self, itemPath="", itemFile="items.yaml", autosave=True, journal=False, compact=100, store=None, cache=False):
 		self.autosave = autosave
+		self._cache = cache #keep binary snapshot of items file
+		self.flusher = None #`vendmachine.persist.Flusher` to save in the background, if any
 		self._defer = False
+		self._dirty = False
 		if os.path.isabs(itemFile):
 			self._itemFile = itemFile #file provided in configuration is already absolute
 		else:
 			self._itemFile = os.path.join(itemPath, itemFile) #combine with config directory
-		self._used_motors = [None]*8 #stores which motor slots are currently used
+		self._store = store #`vendmachine.storage.SqliteStorage` used in place of the items file, if any
+		self._journal = Journal(self._itemFile + ".journal") if journal and store is None else None
+		self._compact = compact #journal records to allow before rewriting items file
+		self._pending = [] #change records not yet written to journal or database
+		self._snapshot = False #whether a full save is needed (change can't be journaled)
+		self._file_key = None #modification time and size of items file when last loaded or saved
+		self._base = None #items and channels in the items file when last loaded or saved, to tell what was edited
+		self._epoch = secrets.token_hex(4) #distinguishes versions from before a restart
+		self._versions = {"items": 0, "channels": 0} #increased on every change to each resource
+		self._modified = {"items": time.time(), "channels": time.time()} #time of last change to each resource
+		self._encoded = {} #JSON response bodies, plain and gzipped, by `(kind, key)` (see `Items.encoded()`)
+		self._names = None #item names in order, and their string forms, for paging (see `Items.query_items()`)
+		self._subscribers = []
+		self._changes = [] #change records not yet passed to subscribers
+		self._motors = {} #index of channel using each motor
+		self._item_channels = {} #index of channels holding each item
 		self.load()
 
 	def load(self):
-		if os.path.isfile(self._itemFile):
+		if self._store is not None:
+			print("Loading item list from database")
+			self._populate(self._store.load_items(), "database")
+			self._verify()
+			self.defer(False)
+		elif os.path.isfile(self._itemFile):
 			print("Loading item list from file '{}'".format(self._itemFile))
 			try:
-				with open(self._itemFile, "r") as f:
-					try:
-						obj = yaml.safe_load(f)
-					except yaml.YAMLError as e:
-						print("Invalid YAML File: '{}'".format(self._itemFile))
-						print("details: {}".format(e))
-						raise
+				try:
+					self._file_key = file_key(self._itemFile)
+					obj = load_yaml(self._itemFile, self._cache)
+				except yaml.YAMLError as e:
+					print("Invalid YAML File: '{}'".format(self._itemFile))
+					print("details: {}".format(e))
+					raise
 			except EnvironmentError as e:
 				print("Unable to open items file '{}'".format(self._itemFile))
 				raise
-			self.defer(True)
-			try:
-				self._items = {}
-				self._channels = {}
-				if type(obj.get("items")) != dict:
-					raise ValueError("Mapping 'items' missing from items file '{}'".format(self._itemFile))
-				if type(obj.get("channels")) != dict:
-					raise ValueError("Mapping 'channels' missing from items file '{}'".format(self._itemFile))
-				items = obj["items"]
-				channels = obj["channels"]
-				for k, v in items.items():
-					try:
-						price = v["price"]
-					except KeyError:
-						print("Item '{}' missing price".format(k))
-						raise
-					self.add_item(k, **v)
-				for k, v in channels.items():
-					try:
-						motor = v["motor"]
-					except KeyError:
-						print("Channel '{}' missing property 'motor'".format(k))
-						raise
-					qty = v.get("qty") #default qty to None (turned into 0)
-					try:
-						item = v["item"]
-					except KeyError:
-						print("Channel '{}' missing property 'item'".format(k))
-						raise
-					self.add_channel(k, item, motor, qty)
-			except (KeyError, ValueError) as e:
-				print("Error reading items file '{}'".format(self._itemFile))
-				raise
+			self._populate(obj, "items file '{}'".format(self._itemFile))
+			self._base = self._file_state(obj["items"], obj["channels"])
+			self.replay()
+			self._verify()
 			self.defer(False)
 		else:
 			if os.path.exists(self._itemFile):
 				raise EnvironmentError("Config path '{}' exists but is not a file".format(self._itemFile))
 			print("Creating item list")
 			self._items = {}
+			self._channels = ChannelTable()
+			self._motors = {}
+			self._item_channels = {}
+			self.replay()
+			self._verify()
 			self.dirty()
+
+	def _populate(self, obj, source):
+		self.defer(True)
+		try:
+			self._items = {}
+			self._channels = ChannelTable()
+			self._motors = {}
+			self._item_channels = {}
+			if type(obj.get("items")) != dict:
+				raise ValueError("Mapping 'items' missing from {}".format(source))
+			if type(obj.get("channels")) != dict:
+				raise ValueError("Mapping 'channels' missing from {}".format(source))
+			items = obj["items"]
+			channels = obj["channels"]
+			for k, v in items.items():
+				try:
+					price = v["price"]
+				except KeyError:
+					print("Item '{}' missing price".format(k))
+					raise
+				self.add_item(k, **v)
+			for k, v in channels.items():
+				try:
+					motor = v["motor"]
+				except KeyError:
+					print("Channel '{}' missing property 'motor'".format(k))
+					raise
+				qty = v.get("qty") #default qty to None (turned into 0)
+				try:
+					item = v["item"]
+				except KeyError:
+					print("Channel '{}' missing property 'item'".format(k))
+					raise
+				self.add_channel(k, item, motor, qty)
+		except (KeyError, ValueError) as e:
+			print("Error reading {}".format(source))
+			raise
+		self._dirty = False #source already matches
+		self._pending = []
+
+	def reload(self):
+		"""Apply changes made to the items file since it was last loaded or saved.
+
+		Only items and channels edited in the file are changed, so changes not yet
+		saved to the file (such as those still in the journal) are kept, unless the
+		same item or channel was edited. The file is then rewritten to hold both.
+		Returns a list of change records (as passed to `Items.dirty()`) describing
+		what changed. If the new file is invalid, or the edits can't be applied (for
+		instance, two channels would share a motor), raises `ValueError` without
+		changing anything.
+
+		Does nothing when items are kept in a database.
+		"""
+		if self._store is not None:
+			return []
+		key = file_key(self._itemFile)
+		if key is None or key == self._file_key: #missing, or our own save
+			return []
+		print("Reloading item list from file '{}'".format(self._itemFile))
+		obj = load_yaml(self._itemFile, self._cache)
+		if not isinstance(obj, dict) or type(obj.get("items")) != dict or type(obj.get("channels")) != dict:
+			raise ValueError("Mappings 'items' and 'channels' required in items file '{}'".format(self._itemFile))
+		items, channels = self._file_state(obj["items"], obj["channels"])
+		if self._base is not None:
+			base_items, base_channels = self._base
+		else: #nothing to tell edits from, so the file replaces everything
+			base_items, base_channels = self._items, self._channels
+
+		set_items = [(name, item) for (name, item) in items.items() if base_items.get(name) != item]
+		del_items = [name for name in base_items if name not in items and name in self._items]
+		set_channels = [(channel, obj) for (channel, obj) in sorted(channels.items()) if base_channels.get(channel) != obj]
+		del_channels = [channel for channel in base_channels if channel not in channels and channel in self._channels]
+		unsaved = self._dirty or (self._journal is not None and len(self._journal) > 0)
+		with self.transaction():
+			#free motors first, so channels can swap them
+			for channel in del_channels + [channel for (channel, obj) in set_channels if channel in self._channels]:
+				self.del_channel(channel)
+			for (name, item) in set_items:
+				if name in self._items:
+					self.replace_item(name, **item)
+				else:
+					self.add_item(name, **item)
+			for name in del_items:
+				self.del_item(name)
+			for (channel, obj) in set_channels:
+				self.add_channel(channel, obj.item, obj.motor, obj.qty)
+			self._verify()
+			if not unsaved: #file already matches
+				self._pending = []
+				self._dirty = False
+				self._snapshot = False
+		if unsaved:
+			self.save() #merge unsaved changes into the file, compacting the journal
+		else:
+			self._file_key = key
+			self._base = (items, channels)
+		changes = [("del_channel", channel) for channel in del_channels]
+		changes += [("item", name, dict(self._items[name])) for (name, item) in set_items if name in self._items]
+		changes += [("del_item", name) for name in del_items]
+		changes += [("channel", channel, self._channels[channel].to_dict()) for (channel, obj) in set_channels if channel in self._channels]
+		print("Reloaded {} change(s)".format(len(changes)))
+		return changes
+
+	def _file_state(self, items, channels):
+		"""Return a copy of the items and channels in an items file, to compare with later edits."""
+		return (copy.deepcopy(items), {int(k): Channel.from_dict(v) for (k, v) in channels.items()})
+
+	def replay(self):
+		if self._journal is None:
+			return
+		n = 0
+		for record in self._journal.replay():
+			self._apply(record)
+			n += 1
+		if n:
+			print("Replayed {} change(s) from journal".format(n))
+			self._snapshot = True #compact journal into items file
+			self._dirty = True
+
+	def _apply(self, record):
+		op, key = record[0], record[1]
+		if op == "item":
+			self._items[key] = record[2]
+		elif op == "del_item":
+			self._items.pop(key, None)
+		elif op == "channel":
+			channel = int(key)
+			if channel in self._channels:
+				self._unlink(channel)
+			self._link(channel, Channel.from_dict(record[2]))
+		elif op == "del_channel":
+			channel = int(key)
+			if channel in self._channels:
+				self._unlink(channel)
+		else:
+			raise ValueError("Unknown journal record '{}'".format(op))
+
+	def _link(self, channel, obj):
+		self._channels[channel] = obj
+		self._motors[obj.motor] = channel
+		self._item_channels.setdefault(obj.item, set()).add(channel)
+
+	def _unlink(self, channel):
+		obj = self._channels.pop(channel)
+		if self._motors.get(obj.motor) == channel:
+			del self._motors[obj.motor]
+		channels = self._item_channels.get(obj.item)
+		if channels is not None:
+			channels.discard(channel)
+			if not channels:
+				del self._item_channels[obj.item]
+		return obj
+
+	def _build_indexes(self):
+		motors = {}
+		item_channels = {}
+		for channel, obj in self._channels.items():
+			if obj.motor in motors:
+				raise ValueError("Motor '{}' is used by both channel '{}' and channel '{}'".format(obj.motor, motors[obj.motor], channel))
+			if obj.item not in self._items:
+				raise ValueError("Channel '{}' has invalid item '{}'".format(channel, obj.item))
+			motors[obj.motor] = channel
+			item_channels.setdefault(obj.item, set()).add(channel)
+		return motors, item_channels
+
+	def _verify(self):
+		motors, item_channels = self._build_indexes()
+		if motors != self._motors or item_channels != self._item_channels:
+			print("Item indexes out of date, rebuilding")
+			self._motors, self._item_channels = motors, item_channels
 	
 	def add_item(self, name, price, **kwargs):
 		if name in self._items:
@@ -79,9 +361,11 @@ class Items():
 			print("Invalid price '{}'".format(price))
 		if price < 0:
 			raise ValueError("Negative price '{}'".format(price))
+		if isinstance(name, str):
+			name = sys.intern(name) #shared with channels holding the item
 		self._items[name] = kwargs
 		self._items[name]["price"] = price
-		self.dirty()
+		self.dirty(("item", name, dict(self._items[name])))
 
 	def add_channel(self, channel, item, motor, qty=None):
 		try:
@@ -109,20 +393,18 @@ class Items():
 			print("Invalid motor '{}'".format(motor))
 		if motor < 0 or motor > 7:
 			raise ValueError("Channel '{}' has out-of-range motor '{}'".format(channel, motor))
-		if self._used_motors[motor] is not None:
-			raise ValueError("Motor '{}' is already in use by channel '{}'".format(motor, self._used_motors[motor]))
-		self._used_motors[motor] = channel
-		self._channels[channel] = {
-			"item": str(item),
-			"motor": motor,
-			"qty": int(qty),
-		}
-		self.dirty()
+		if self._motors.get(motor, channel) != channel:
+			raise ValueError("Motor '{}' is already in use by channel '{}'".format(motor, self._motors[motor]))
+		obj = Channel(item, motor, int(qty))
+		if channel in self._channels:
+			self._unlink(channel)
+		self._link(channel, obj)
+		self.dirty(("channel", channel, obj.to_dict()))
 
 	def update_channel(self, channel, motor=None, item=None, qty=None):
 		if channel not in self._channels:
 			raise ValueError("Channel '{}' does not exist".format(channel))
-		channel = self._channels[channel]
+		obj = self._channels[channel].copy()
 		dirty = False
 		if motor != None:
 			try:
@@ -131,23 +413,23 @@ class Items():
 				print("Invalid motor '{}'".format(motor))
 			if motor < 0 or motor > 7:
 				raise ValueError("Out-of-range motor '{}'".format(motor))
-			if self._used_motors[motor] is not None:
-				raise ValueError("Motor '{}' is already in use my channel '{}'".format(motor, self._used_motors[motor]))
-			self._used_motors[channel["motor"]] = None #old motor is no longer in use
-			self._used_motors[motor] = channel #new motor is in use
-			channel["motor"] = motor
+			if self._motors.get(motor, channel) != channel:
+				raise ValueError("Motor '{}' is already in use by channel '{}'".format(motor, self._motors[motor]))
+			obj.motor = motor
 			dirty = True
 		if item != None:
 			item = str(item)
 			if item not in self._items:
 				raise ValueError("Invalid item '{}'".format(item))
-			channel["item"] = name
+			obj.item = sys.intern(item)
 			dirty = True
 		if qty != None:
-			channel["qty"] = int(qty)
+			obj.qty = int(qty)
 			dirty = True
 		if dirty:
-			self.dirty()
+			self._unlink(channel) #indexes are updated all at once, after validation
+			self._link(channel, obj)
+			self.dirty(("channel", channel, obj.to_dict()))
 		else:
 			raise ValueError("No entries changed")
 
@@ -171,30 +453,26 @@ class Items():
 				dirty = True
 			item[k] = v
 		if dirty:
-			self.dirty()
+			self.dirty(("item", name, dict(item)))
 		else:
 			raise ValueError("No entries changed")
 	
 	def del_item(self, name):
 		if name not in self._items:
 			raise ValueError("Item '{}' does not exist".format(name))
+		defer = self._defer
 		self.defer(True)
 		del self._items[name]
-		channels = []
-		for channel, obj in self._channels.items():
-			if obj["item"] == name:
-				channels.append(channel)
-		for channel in channels:
+		for channel in sorted(self._item_channels.get(name, ())):
 			self.del_channel(channel)
-		self.dirty()
-		self.defer(False)
+		self.dirty(("del_item", name))
+		self.defer(defer)
 		
 	def del_channel(self, channel):
 		if channel not in self._channels:
 			raise ValueError("Channel '{}' does not exist".format(channel))
-		self._used_motors[self._channels[channel]["motor"]] = None
-		del self._channels[channel]
-		self.dirty()
+		self._unlink(channel)
+		self.dirty(("del_channel", channel))
 
 	def get_item(self, name=None, channel=None):
 		if name is not None:
@@ -202,20 +480,366 @@ class Items():
 		if channel is not None:
 			if channel not in self._channels:
 				return None
-			return self._items[self._channels[channel]["item"]]
+			return self._items[self._channels[channel].item]
 		raise ValueError("Must specify name or channel of item to search for")
 	
 	def get_channel(self, channel):
 		return self._channels.get(channel) #should we return actual item along with this?
+
+	def channels_for_item(self, name):
+		"""Return a sorted list of the channels holding item `name`."""
+		return sorted(self._item_channels.get(name, ()))
+
+	def channel_for_motor(self, motor):
+		"""Return the channel driven by `motor`, or `None` if it is unused."""
+		return self._motors.get(motor)
 	
-	def dirty(self):
+	def query_items(self, after=None, limit=None, fields=None, min_price=None, max_price=None, attrs=None):
+		"""Return a page of items, in name order, and the cursor for the next page.
+
+		`after`: Only return items named after this (the cursor from the previous page).    
+		`limit`: Return at most this many items.    
+		`fields`: Only include these attributes of each item.    
+		`min_price`, `max_price`: Only return items in this price range (inclusive).    
+		`attrs`: Only return items whose attributes have these values (compared as strings).
+
+		The cursor is `None` when there are no more items.
+		"""
+		if self._names is None:
+			names = sorted(self._items, key=str) #names from YAML may not all be strings
+			self._names = (names, [str(name) for name in names])
+		names, keys = self._names
+		start = bisect.bisect_right(keys, str(after)) if after is not None else 0
+		page = {}
+		for name in itertools.islice(names, start, None):
+			item = self._items[name]
+			if min_price is not None and item["price"] < min_price:
+				continue
+			if max_price is not None and item["price"] > max_price:
+				continue
+			if attrs and any(k not in item or str(item[k]) != str(v) for (k, v) in attrs.items()):
+				continue
+			if limit is not None and len(page) >= limit: #another matches, so there is a next page
+				return page, str(list(page)[-1])
+			page[name] = item if fields is None else {k: item[k] for k in fields if k in item}
+		return page, None
+
+	def query_channels(self, after=None, limit=None, fields=None, item=None, motor=None,
+	                   min_price=None, max_price=None, min_qty=None):
+		"""Return a page of channels, in channel order, and the cursor for the next page.
+
+		`after`: Only return channels numbered after this (the cursor from the previous page).    
+		`limit`: Return at most this many channels.    
+		`fields`: Only include these of `item`, `motor`, and `qty`.    
+		`item`, `motor`: Only return channels holding this item, or driven by this motor.    
+		`min_price`, `max_price`: Only return channels whose item is in this price range (inclusive).    
+		`min_qty`: Only return channels holding at least this many.
+
+		The cursor is `None` when there are no more channels.
+		"""
+		if item is not None:
+			channels = self.channels_for_item(item)
+		elif motor is not None:
+			channels = [self._motors[motor]] if motor in self._motors else []
+		else:
+			channels = list(self._channels)
+		if after is not None:
+			channels = channels[bisect.bisect_right(channels, after):]
+		page = {}
+		for channel in channels:
+			obj = self._channels[channel]
+			if motor is not None and obj.motor != motor:
+				continue
+			price = self._items[obj.item]["price"]
+			if min_price is not None and price < min_price:
+				continue
+			if max_price is not None and price > max_price:
+				continue
+			if min_qty is not None and obj.qty < min_qty:
+				continue
+			if limit is not None and len(page) >= limit:
+				return page, list(page)[-1]
+			obj = obj.to_dict()
+			page[channel] = obj if fields is None else {k: obj[k] for k in fields if k in obj}
+		return page, None
+
+	def export(self):
+		"""Yield a change record (as passed to `Items.dirty()`) for every item, then every channel.
+
+		Records are made one at a time as they are read, and can be applied
+		again with `Items.import_records()`.
+		"""
+		for name in list(self._items):
+			item = self._items.get(name)
+			if item is not None: #not deleted since starting
+				yield ("item", name, dict(item))
+		for channel in range(ChannelTable.size):
+			obj = self._channels.get(channel)
+			if obj is not None:
+				yield ("channel", channel, obj.to_dict())
+
+	def import_records(self, records, size=100):
+		"""Apply change records (as made by `Items.export()`) from the iterable `records`.
+
+		Records are validated like any other change, and applied in transactions of up to
+		`size` records, so only one group is held in memory at a time. Yields the number
+		of records applied after each group is committed. If a record is invalid, raises
+		`ValueError` naming it; groups already committed are kept.
+		"""
+		count = 0
+		records = iter(records)
+		while True:
+			undo = {} #only the items a group changes are kept for rolling it back
+			with self.transaction(undo):
+				n = 0
+				for record in records:
+					count += 1
+					try:
+						self._import(record, undo)
+					except (ValueError, TypeError, KeyError, IndexError) as e:
+						raise ValueError("Record {}: {}".format(count, e))
+					n += 1
+					if n == size:
+						break
+			if n == 0:
+				return
+			yield count
+			if n < size:
+				return
+
+	def _import(self, record, undo):
+		if not isinstance(record, (list, tuple)) or len(record) < 2:
+			raise ValueError("Expected a change record")
+		op, key = record[0], record[1]
+		if op in ("item", "del_item") and key not in undo:
+			item = self._items.get(key)
+			undo[key] = copy.deepcopy(item) if item is not None else None
+		if op == "item":
+			if not isinstance(record[2], dict):
+				raise ValueError("Item must be an object")
+			item = dict(record[2])
+			price = item.pop("price")
+			if key in self._items:
+				self.replace_item(key, price, **item)
+			else:
+				self.add_item(key, price, **item)
+		elif op == "channel":
+			obj = record[2]
+			if int(key) in self._channels:
+				self.replace_channel(key, obj["item"], obj["motor"], obj.get("qty"))
+			else:
+				self.add_channel(key, obj["item"], obj["motor"], obj.get("qty"))
+		elif op == "del_item":
+			self.del_item(key)
+		elif op == "del_channel":
+			self.del_channel(int(key))
+		else:
+			raise ValueError("Unknown change record '{}'".format(op))
+
+	def catalog_entry(self, channel):
+		"""Return what a kiosk needs to know about `channel`: its item, price,
+		price text, and quantity. Returns `None` if the channel doesn't exist.
+		"""
+		obj = self._channels.get(channel)
+		if obj is None:
+			return None
+		price = self._items[obj.item]["price"]
+		return {"item": obj.item, "price": price, "text": "${:,.2f}".format(price), "qty": obj.qty}
+
+	def catalog(self):
+		"""Return every channel joined with its item (see `Items.catalog_entry()`),
+		along with the version of the items and channels it was made from.
+		"""
+		return {"version": self.version("items", "channels")[0],
+		        "channels": {channel: self.catalog_entry(channel) for channel in self._channels}}
+
+	def catalog_delta(self, records):
+		"""Return the catalog entries changed by change records `records`, mapping
+		each changed channel to its new entry, or `None` if it was removed.
+
+		Returns `None` if anything may have changed, and the whole catalog should be fetched.
+		"""
+		channels = set()
+		for record in records:
+			if record is None:
+				return None
+			op, key = record[0], record[1]
+			if op == "item":
+				channels.update(self._item_channels.get(key, ()))
+			elif op in ("channel", "del_channel"):
+				channels.add(int(key))
+			#deleting an item deletes its channels first
+		return {channel: self.catalog_entry(channel) for channel in sorted(channels)}
+
+	def dirty(self, record=None):
 		self._dirty = True
-		if self.autosave and not self._defer:
-			self.save()
+		self._touch(record)
+		self._changes.append(record)
+		if self._journal is not None or self._store is not None:
+			if record is None:
+				self._snapshot = True
+			else:
+				self._pending.append(record)
+		if not self._defer:
+			self._publish()
+			if self.autosave:
+				self._schedule()
 
 	def defer(self, defer):
 		self._defer = defer
-		if not defer and self._dirty and self.autosave:
+		if not defer:
+			self._publish()
+			if self._dirty and self.autosave:
+				self._schedule()
+
+	def subscribe(self, callback):
+		"""Call `callback(records)` with the list of change records (as passed to
+		`Items.dirty()`) after every change, or group of changes made together.
+
+		Changes made in a transaction are passed on once it completes, and never
+		if it is rolled back. A `None` record means everything may have changed.
+		"""
+		self._subscribers.append(callback)
+
+	def _publish(self):
+		if not self._changes:
+			return
+		changes, self._changes = self._changes, []
+		for callback in self._subscribers:
+			try:
+				callback(changes)
+			except Exception as e: #don't undo a change already made
+				print("Error handling item change: {}".format(e))
+
+	@contextlib.contextmanager
+	def transaction(self, undo=None):
+		"""Make a group of changes together, or not at all.
+
+		Changes made inside the block are saved once at the end. If the
+		block raises, every change is undone before the exception propagates.
+
+		Every item is copied at the start, to undo changes with. Instead, a block
+		changing only a few items can pass an `undo` dict, which it fills with each
+		item it is about to change (`None` if it doesn't exist yet), as it was
+		before its first change.
+		"""
+		state = self._state(undo is None)
+		defer = self._defer
+		self.defer(True)
+		try:
+			yield self
+		except BaseException:
+			self._restore(state, undo)
+			self._defer = defer
+			raise
+		self.defer(defer)
+
+	def _state(self, items=True):
+		return (copy.deepcopy(self._items) if items else None, self._channels.copy(),
+		        list(self._pending), list(self._changes), self._dirty, self._snapshot)
+
+	def _restore(self, state, undo=None):
+		(items, self._channels,
+		 self._pending, self._changes, self._dirty, self._snapshot) = state
+		if items is not None:
+			self._items = items
+		else:
+			for (name, item) in undo.items():
+				if item is None:
+					self._items.pop(name, None)
+				else:
+					self._items[name] = item
+		self._motors, self._item_channels = self._build_indexes()
+		self._touch(None)
+
+	def _touch(self, record):
+		now = time.time()
+		for resource in (record_resources[record[0]],) if record is not None else ("items", "channels"):
+			self._versions[resource] += 1
+			self._modified[resource] = now
+		if record is None or record[0] == "del_item" or (record[0] == "item" and not self._named(record[1])):
+			self._names = None #only rebuilt when names come or go
+		if record is None:
+			self._encoded.clear()
+		else: #only the collection and the one item or channel changed
+			resource = record_resources[record[0]]
+			self._encoded.pop((resource, None), None)
+			self._encoded.pop((resource[:-1], record[1]), None)
+			self._encoded.pop(("catalog", None), None)
+
+	def _named(self, name):
+		"""Return whether item `name` is already in `Items._names`, or that isn't built yet."""
+		if self._names is None:
+			return True
+		names, keys = self._names
+		i = bisect.bisect_left(keys, str(name))
+		return i < len(names) and names[i] == name
+
+	def version(self, *resources):
+		"""Return a tag that changes whenever any of `resources` (`"items"`, `"channels"`) change,
+		along with the time they were last changed.
+
+		Used for HTTP ETags and Last-Modified headers.
+		"""
+		tag = "{}-{}".format(self._epoch, ".".join(str(self._versions[resource]) for resource in resources))
+		return tag, max(self._modified[resource] for resource in resources)
+
+	def encoded(self, kind, key=None, gzip=False):
+		"""Return the JSON encoded `{kind: ...}` document for an API response, as bytes.
+
+		`kind` is `"items"`, `"channels"`, or `"catalog"` (see `Items.catalog()`) for a
+		whole collection, or `"item"` or `"channel"` for the one named by `key`
+		(`None` if it doesn't exist).
+		With `gzip`, the body is returned gzipped.
+
+		Bodies are encoded once and kept until the item or channel in them changes.
+		"""
+		if kind in ("item", "channel") and (self._items if kind == "item" else self._channels).get(key) is None:
+			return None
+		bodies = self._encoded.get((kind, key))
+		if bodies is None:
+			if kind == "items":
+				obj = self._items
+			elif kind == "channels":
+				obj = self._channels.to_dict()
+			elif kind == "item":
+				obj = self._items[key]
+			elif kind == "channel":
+				obj = self._channels[key].to_dict()
+			elif kind == "catalog":
+				obj = self.catalog()
+			else:
+				raise ValueError("Unknown kind '{}'".format(kind))
+			bodies = self._encoded[(kind, key)] = [codec.dumps({kind: obj}), None]
+		if gzip:
+			if bodies[1] is None:
+				bodies[1] = codec.compress(bodies[0])
+			return bodies[1]
+		return bodies[0]
+
+	def _schedule(self):
+		if self.flusher is not None:
+			self.flusher.notify(self)
+		else:
+			self.flush()
+
+	def flush(self):
+		"""Persist outstanding changes.
+
+		Without a journal this is the same as `Items.save()`. With one,
+		pending changes are appended to the journal, and the journal is
+		compacted into the items file once it grows past `compact` records.
+		With a database, pending changes are committed as one transaction.
+		"""
+		if not self._dirty:
+			return
+		if self._journal is None or self._snapshot or self._store is not None:
+			return self.save()
+		self._journal.append(self._pending)
+		self._pending = []
+		self._dirty = False
+		if len(self._journal) >= self._compact:
+			print("Compacting item journal")
 			self.save()
 	
 	def is_dirty(self):
@@ -223,6 +847,9 @@ class Items():
 
 	def items(self):
 		return self._items
+
+	def path(self):
+		return self._itemFile
 	
 	def channels(self):
 		return self._channels
@@ -235,13 +862,24 @@ class Items():
 	#	return item in self._items
 
 	def exit(self):
-		if self._dirty:
+		"""Save anything unsaved, compacting the journal (if any) into the items file."""
+		if self._dirty or (self._journal is not None and len(self._journal) > 0):
 			try:
 				self.save()
 			except EnvironmentError: #can't do much, just shutdown anyway.
 				pass
 
 	def save(self, itemFile=None):
+		if itemFile == None and self._store is not None:
+			if self._snapshot: #changes not known record by record
+				print("Saving item list to database")
+				self._store.save_items(self._items, self._channels.to_dict())
+			else:
+				self._store.commit(self._pending)
+			self._dirty = False
+			self._pending = []
+			self._snapshot = False
+			return
 		if itemFile == None:
 			itemFile = self._itemFile
 			print("Saving item list")
@@ -249,11 +887,17 @@ class Items():
 			if os.path.exists(itemFile) and not os.path.isfile(itemFile):
 				raise EnvironmentError("Config path '{}' exists but is not a file".format(itemFile))
 			print("Saving item list to file '{}'".format(itemFile))
-		obj = {"items": self._items, "channels": self._channels}
+		obj = {"items": self._items, "channels": self._channels.to_dict()}
 		try:
-			with open(itemFile, "w") as f:
-				yaml.safe_dump(obj, f)
-			self._dirty = False
+			save_yaml(itemFile, obj, self._cache and itemFile == self._itemFile)
+			if itemFile == self._itemFile:
+				self._dirty = False
+				self._file_key = file_key(itemFile)
+				self._base = self._file_state(self._items, self._channels.to_dict())
+				if self._journal is not None: #journal is now part of items file
+					self._journal.truncate()
+					self._pending = []
+					self._snapshot = False
 		except EnvironmentError as e:
 			print("Unable to save item list.\nError: {}".format(e))
 			raise
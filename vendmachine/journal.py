@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+"""Append-only journal of changes made to a store.
+
+Used by `vendmachine.items.Items` so that each change only appends a
+short record to a log, instead of rewriting the whole YAML file.
+The log is periodically compacted back into the YAML file.
+
+Each line of the journal is a single JSON record. Records describe
+the final state of one entry (or its deletion), so replaying a record
+more than once is harmless.
+"""
+
+import os
+import json
+
+class Journal():
+	def __init__(self, path):
+		self._path = path
+		self._count = 0
+
+	def append(self, records):
+		"""Append `records` to the journal, syncing them to disk."""
+		if not records:
+			return
+		lines = "".join(json.dumps(record, separators=(",", ":"), default=str) + "\n" for record in records)
+		try:
+			with open(self._path, "a") as f:
+				f.write(lines)
+				f.flush()
+				os.fsync(f.fileno())
+		except EnvironmentError as e:
+			print("Unable to write journal '{}'.\nError: {}".format(self._path, e))
+			raise
+		self._count += len(records)
+
+	def replay(self):
+		"""Yield every complete record in the journal.
+
+		Stops at the first unreadable line, which is most likely
+		a record torn by a crash or power cut.
+		"""
+		self._count = 0
+		if not os.path.isfile(self._path):
+			return
+		with open(self._path, "r") as f:
+			for line in f:
+				if not line.endswith("\n"):
+					print("Ignoring incomplete record at end of journal '{}'".format(self._path))
+					return
+				try:
+					record = json.loads(line)
+				except ValueError:
+					print("Ignoring unreadable record in journal '{}'".format(self._path))
+					return
+				self._count += 1
+				yield record
+
+	def truncate(self):
+		"""Discard every record in the journal."""
+		if os.path.exists(self._path):
+			os.remove(self._path)
+		self._count = 0
+
+	def __len__(self):
+		return self._count
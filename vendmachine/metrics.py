@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+"""Counters, gauges, and histograms describing the running server.
+
+Every metric is registered in `registry` when it is made, and
+`render()` formats them all in the Prometheus text exposition format
+(served at `/api/metrics`). HTTP requests are counted by
+`vendmachine.instrument`, keeping this module free of Flask so that
+storage code can record metrics too.
+
+The server runs every request, socket event, and background task as
+green threads on a single OS thread, which only switch at I/O or
+`eventlet.sleep()`. Recording a value never yields, so metrics are
+kept in plain dictionaries without locks, and recording one costs a
+dictionary update.
+"""
+
+import bisect
+
+registry = []
+"""Every metric made, in the order made."""
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+"""Histogram bucket upper bounds (in seconds), suited to request latencies."""
+
+class Metric():
+	kind = None
+
+	def __init__(self, name, help, labels=()):
+		self.name = name
+		self.help = help
+		self.labels = tuple(labels)
+		self._values = {} #value (or histogram state) by tuple of label values
+		registry.append(self)
+
+	def _label_text(self, values, extra=()):
+		pairs = list(zip(self.labels, values)) + list(extra)
+		if not pairs:
+			return ""
+		return "{" + ",".join('{}="{}"'.format(k, escape(v)) for (k, v) in pairs) + "}"
+
+	def render(self):
+		lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.kind)]
+		for values in sorted(self._values, key=lambda values: tuple(map(str, values))):
+			lines.extend(self._render(values, self._values[values]))
+		return lines
+
+	def _render(self, values, value):
+		return ["{}{} {}".format(self.name, self._label_text(values), number(value))]
+
+class Counter(Metric):
+	"""A count which only increases, such as the number of requests served."""
+	kind = "counter"
+
+	def inc(self, *values, amount=1):
+		self._values[values] = self._values.get(values, 0) + amount
+
+	def get(self, *values):
+		return self._values.get(values, 0)
+
+class Gauge(Metric):
+	"""A value which can go up and down, such as the number of connected clients."""
+	kind = "gauge"
+
+	def set(self, value, *values):
+		self._values[values] = value
+
+	def inc(self, *values, amount=1):
+		self._values[values] = self._values.get(values, 0) + amount
+
+	def dec(self, *values, amount=1):
+		self.inc(*values, amount=-amount)
+
+	def get(self, *values):
+		return self._values.get(values, 0)
+
+class Histogram(Metric):
+	"""Counts of observed values (such as durations) falling under each of `buckets`."""
+	kind = "histogram"
+
+	def __init__(self, name, help, labels=(), buckets=default_buckets):
+		super().__init__(name, help, labels)
+		self.buckets = tuple(sorted(buckets))
+
+	def observe(self, value, *values):
+		state = self._values.get(values)
+		if state is None:
+			state = self._values[values] = [[0]*(len(self.buckets) + 1), 0.0, 0] #counts, sum, count
+		state[0][bisect.bisect_left(self.buckets, value)] += 1
+		state[1] += value
+		state[2] += 1
+
+	def _render(self, values, state):
+		counts, total, count = state
+		lines = []
+		cumulative = 0
+		for (bound, n) in zip(self.buckets + (float("inf"),), counts):
+			cumulative += n
+			lines.append("{}_bucket{} {}".format(self.name, self._label_text(values, [("le", number(bound))]), cumulative))
+		lines.append("{}_sum{} {}".format(self.name, self._label_text(values), number(total)))
+		lines.append("{}_count{} {}".format(self.name, self._label_text(values), count))
+		return lines
+
+def escape(value):
+	return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def number(value):
+	if value == float("inf"):
+		return "+Inf"
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render():
+	"""Return every metric in the Prometheus text format."""
+	lines = []
+	for metric in registry:
+		lines.extend(metric.render())
+	return "\n".join(lines) + "\n"
+
+content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+requests = Counter("vend_http_requests_total", "HTTP requests served.", ("route", "method", "status"))
+request_seconds = Histogram("vend_http_request_duration_seconds", "Time taken to serve HTTP requests.", ("route", "method"))
+socket_connections = Gauge("vend_socket_connections", "Connected websocket clients.")
+socket_emits = Counter("vend_socket_emits_total", "Websocket events sent.", ("event",))
+topic_emits = Counter("vend_socket_topic_emits_total", "Websocket events sent, by topic (`session` for one client, `all` for every client).", ("topic",))
+vends = Counter("vend_vends_total", "Vend attempts, by outcome.", ("outcome",))
+vend_seconds = Histogram("vend_vend_duration_seconds", "Time taken to vend.", ("outcome",),
+                         buckets=(1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0))
+heartbeat_seconds = Histogram("vend_heartbeat_rtt_seconds", "Websocket heartbeat round trip times.")
+throttled = Counter("vend_http_throttled_total", "HTTP requests refused by the rate limiter.", ("class",))
+pulses = Counter("vend_credit_pulses_total", "Credit pulses from the bill acceptor.")
+flush_seconds = Histogram("vend_flush_duration_seconds", "Time taken to save a changed store.", ("store",))
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+"""Helpers for saving stores (`vendmachine.items.Items`,
+`vendmachine.users.Users`, `vendmachine.config.Config`) to disk.
+
+`atomic_write()` makes sure a file is never left half-written, and
+`Flusher` moves saving off the request path, coalescing bursts of
+changes into a single write.
+
+YAML is read and written with libyaml when it is available. `load_yaml()`
+can also keep a binary snapshot of a file next to it (`<file>.cache`),
+which is used in place of parsing the file as long as the file's
+modification time and size haven't changed.
+"""
+
+import os
+import time
+import marshal
+import contextlib
+import eventlet
+import yaml
+
+from vendmachine import metrics
+
+try:
+	from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError: #PyYAML built without libyaml
+	from yaml import SafeLoader, SafeDumper
+
+@contextlib.contextmanager
+def atomic_write(path, mode="w"):
+	"""Open a temporary file to write in place of `path`.
+
+	The temporary file is synced and renamed over `path` once the
+	block exits successfully, and removed if it raises.
+	"""
+	tmp = "{}.tmp".format(path)
+	try:
+		with open(tmp, mode) as f:
+			yield f
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp, path)
+	except BaseException:
+		if os.path.exists(tmp):
+			os.remove(tmp)
+		raise
+
+def file_key(path):
+	"""Return the modification time and size of `path`, or `None` if it doesn't exist.
+
+	Used to tell whether a file has changed.
+	"""
+	try:
+		stat = os.stat(path)
+	except FileNotFoundError:
+		return None
+	return (stat.st_mtime_ns, stat.st_size)
+
+def load_yaml(path, cache=False):
+	"""Load the YAML file at `path`.
+
+	If `cache` is set, use or refresh the file's binary snapshot.
+	Raises `yaml.YAMLError` if the file is invalid.
+	"""
+	if cache:
+		key = file_key(path)
+		try:
+			with open(path + ".cache", "rb") as f:
+				cached_key, obj = marshal.load(f)
+			if tuple(cached_key) == key:
+				return obj
+		except (EnvironmentError, EOFError, ValueError, TypeError): #missing or stale format
+			pass
+	with open(path, "r") as f:
+		obj = yaml.load(f, Loader=SafeLoader)
+	if cache:
+		_write_cache(path, key, obj)
+	return obj
+
+def save_yaml(path, obj, cache=False):
+	"""Atomically write `obj` to `path` as YAML, refreshing its binary snapshot if `cache` is set."""
+	with atomic_write(path) as f:
+		yaml.dump(obj, f, Dumper=SafeDumper)
+	if cache:
+		_write_cache(path, file_key(path), obj)
+
+def _write_cache(path, key, obj):
+	try:
+		with atomic_write(path + ".cache", "wb") as f:
+			marshal.dump((key, obj), f)
+	except ValueError: #contains something marshal can't handle (e.g. dates)
+		pass
+	except EnvironmentError as e: #cache is optional
+		print("Unable to write cache for '{}'.\nError: {}".format(path, e))
+
+class Flusher():
+	"""Saves changed stores from a background green thread.
+
+	A store calls `Flusher.notify()` whenever it changes. Once no store has
+	changed for `quiet` seconds, or `max_delay` seconds after the oldest
+	unsaved change, `flush()` is called on every notified store. A store
+	that fails to save is tried again `quiet` seconds later.
+
+	Nothing is saved in the background until `Flusher.start()`, so that no
+	green thread is left running across `os.fork()`.
+	"""
+
+	def __init__(self, quiet=1.0, max_delay=10.0):
+		self.quiet = quiet
+		self.max_delay = max_delay
+		self._stores = []
+		self._first = None #time of oldest unsaved change
+		self._last = None #time of newest unsaved change
+		self._thread = None
+		self._started = False
+
+	def notify(self, store):
+		"""Schedule `store` to be flushed."""
+		now = time.monotonic()
+		if store not in self._stores:
+			self._stores.append(store)
+		if self._first is None:
+			self._first = now
+		self._last = now
+		if self._thread is None and self._started:
+			self._thread = eventlet.spawn(self._run)
+
+	def start(self):
+		"""Start saving in the background, including any changes notified before now."""
+		self._started = True
+		if self._stores and self._thread is None:
+			self._thread = eventlet.spawn(self._run)
+
+	def _run(self):
+		try:
+			while self._stores:
+				deadline = min(self._last + self.quiet, self._first + self.max_delay)
+				delay = deadline - time.monotonic()
+				if delay > 0:
+					eventlet.sleep(delay)
+				else:
+					self.flush()
+		finally:
+			self._thread = None
+
+	def flush(self, retry=True):
+		"""Immediately flush every store with unsaved changes.
+
+		Stores that fail to save stay dirty, and are scheduled again if `retry` is set.
+		"""
+		stores, self._stores = self._stores, []
+		self._first = self._last = None
+		failed = []
+		for store in stores:
+			start = time.perf_counter()
+			try:
+				store.flush()
+				metrics.flush_seconds.observe(time.perf_counter() - start, type(store).__name__)
+			except EnvironmentError as e:
+				print("Unable to save {}.\nError: {}".format(type(store).__name__, e))
+				failed.append(store)
+		if retry:
+			for store in failed:
+				self.notify(store)
+
+	def drain(self):
+		"""Stop the background thread and flush anything outstanding.
+
+		Stores that still fail to save stay dirty, to be saved on exit.
+		"""
+		if self._thread is not None:
+			self._thread.kill()
+			self._thread = None
+		self.flush(retry=False)
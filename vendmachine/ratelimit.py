@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+"""In-process rate limiting of API requests.
+
+Each client (API key, user, or address) has a token bucket for each class
+of route (`read`, `write`, `admin`). A bucket holds up to `burst` tokens,
+refills at `rate` tokens per second, and each request takes one token.
+Limits are set in the `ratelimit` section of `config.yaml`.
+
+Buckets are kept in order of last use. A bucket that has been idle long
+enough to refill is the same as a new one, so idle buckets are evicted
+from the front as requests arrive, keeping memory proportional to the
+number of recently active clients.
+"""
+
+import time
+import collections
+
+class RateLimiter():
+	def __init__(self, limits=None):
+		self._limits = {} #`(rate, burst)` for each class
+		self._buckets = collections.OrderedDict() #`[tokens, time]` by `(class, client)`, least recently used first
+		self.configure(limits or {})
+
+	def configure(self, limits):
+		"""Set the limits for each class, from a mapping of class to `{"rate": ..., "burst": ...}`.
+
+		Classes without a limit (or with a rate of 0) are not limited.
+		"""
+		self._limits = {}
+		for (cls, limit) in limits.items():
+			if not isinstance(limit, dict) or not limit.get("rate"):
+				continue
+			rate = float(limit["rate"])
+			burst = float(limit.get("burst") or max(1.0, rate)) #room for at least one request
+			if rate < 0 or burst < 1:
+				raise ValueError("Invalid rate limit for '{}'".format(cls))
+			self._limits[cls] = (rate, burst)
+		self._buckets.clear()
+
+	def take(self, cls, client, now=None):
+		"""Take a token for a request of class `cls` from `client`.
+
+		Returns 0 if the request is allowed, or else the number of
+		seconds until it would be.
+		"""
+		limit = self._limits.get(cls)
+		if limit is None:
+			return 0
+		rate, burst = limit
+		if now is None:
+			now = time.monotonic()
+		key = (cls, client)
+		bucket = self._buckets.pop(key, None)
+		if bucket is None:
+			bucket = [burst, now]
+		else:
+			bucket[0] = min(burst, bucket[0] + (now - bucket[1])*rate)
+			bucket[1] = now
+		if bucket[0] >= 1:
+			bucket[0] -= 1
+			wait = 0
+		else:
+			wait = (1 - bucket[0])/rate
+		self._buckets[key] = bucket #most recently used
+		self._evict(now)
+		return wait
+
+	def _evict(self, now):
+		while self._buckets:
+			(cls, client), (tokens, last) = next(iter(self._buckets.items()))
+			limit = self._limits.get(cls)
+			if limit is not None and tokens + (now - last)*limit[0] < limit[1]:
+				return #oldest bucket still refilling, stop here
+			self._buckets.popitem(last=False)
+
+	def __len__(self):
+		return len(self._buckets)
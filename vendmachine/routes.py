@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
-from flask import render_template, abort
+from flask import render_template, abort, request
+from flask_socketio import join_room, leave_room, rooms
+from flask_login import current_user
 
+from vendmachine import metrics, events
 from vendmachine.server import server
 from vendmachine.config import config
 
@@ -19,18 +22,81 @@ except AttributeError: #need to make Server for pdoc to run
 def connect():
 	#can return False to reject connection
 	print("Websocket connected")
+	metrics.socket_connections.inc()
+	server.sessions[request.sid] = current_user.get_id() #vends can only send results to their own user
+	server.heartbeat.add(request.sid, request.remote_addr)
+	for topic in events.default_topics:
+		join_room(topic)
 
-def messageReceived(methods=['GET', 'POST']):
-	print('message was received!!!')
+@socketio.on('disconnect')
+def disconnect():
+	metrics.socket_connections.dec()
+	server.sessions.pop(request.sid, None)
+	server.heartbeat.remove(request.sid)
+
+@socketio.on('subscribe')
+def subscribe(json):
+	"""Join the topics listed in `json["topics"]` (see `vendmachine.events`).
+
+	Returns the topics now subscribed to, or an error.
+	"""
+	wanted = json.get("topics") if isinstance(json, dict) else None
+	if not isinstance(wanted, list) or any(topic not in events.topics for topic in wanted):
+		return {"error": "Unknown topic"}
+	if events.admin_topics.intersection(wanted) and not current_user.is_admin:
+		return {"error": "Forbidden"}
+	for topic in wanted:
+		join_room(topic)
+	return {"topics": subscriptions()}
+
+@socketio.on('unsubscribe')
+def unsubscribe(json):
+	"""Leave the topics listed in `json["topics"]`. Returns the topics still subscribed to."""
+	wanted = json.get("topics") if isinstance(json, dict) else None
+	if not isinstance(wanted, list):
+		return {"error": "Expected a list of topics"}
+	for topic in wanted:
+		if topic in events.topics:
+			leave_room(topic)
+	return {"topics": subscriptions()}
+
+@socketio.on('resume')
+def resume(json):
+	"""Send a reconnecting client the events it missed on its topics, after the
+	`json["eventSeq"]` it last saw. For topics where they are no longer kept,
+	or if `json["epoch"]` shows the number is from before a restart, send a
+	snapshot instead (see `vendmachine.server.Server.snapshot()`).
+
+	Returns the number of events replayed and the topics snapshotted.
+	"""
+	try:
+		seq = int(json["eventSeq"])
+	except (TypeError, KeyError, ValueError):
+		return {"error": "Expected eventSeq"}
+	missed, stale = server.event_log.since(subscriptions(), seq, json.get("epoch"))
+	for (n, event, data) in missed:
+		server.emit(event, dict(data, eventSeq=n, epoch=server.event_log.epoch), room=request.sid)
+	for topic in sorted(stale):
+		snapshot = server.snapshot(topic)
+		if snapshot is not None:
+			server.emit(*snapshot, room=request.sid)
+	return {"replayed": len(missed), "snapshots": sorted(stale)}
+
+def subscriptions():
+	return sorted(topic for topic in rooms() if topic in events.topics)
 
 @socketio.on('status')
 def status(json, methods=['GET', 'POST']):
-	server.status_update()
+	"""Send the full status to the client asking for it (see `vendmachine.broadcast`)."""
+	server.emit('status', server.snapshot("status")[1], room=request.sid)
 
 @socketio.on('heartbeat')
 def heartbeat(json, methods=['GET', 'POST']):
-	print('received heartbeat: ' + str(json))
-	socketio.emit('heartbeat', json, callback=messageReceived)
+	"""Acknowledge a client's heartbeat, so it can time the round trip.
+
+	The server measures its own round trips to each client (see `vendmachine.heartbeat`).
+	"""
+	return json
 
 @app.route("/")
 def root():
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+"""Append-only ledger of every vend attempt.
+
+Sales are kept in a SQLite database (`sales.db` by default, set by `sales`
+in the `files` section of `config.yaml`). Alongside the raw sales, totals
+are kept per hour, channel, item, and outcome, so summaries over long
+periods only read one row per hour instead of every sale.
+"""
+
+import os
+import time
+import sqlite3
+
+schema = """
+CREATE TABLE IF NOT EXISTS sales (
+	id INTEGER PRIMARY KEY,
+	time REAL NOT NULL,
+	channel INTEGER NOT NULL,
+	item TEXT NOT NULL,
+	price REAL NOT NULL,
+	outcome TEXT NOT NULL,
+	duration REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sales_time ON sales (time);
+CREATE TABLE IF NOT EXISTS hourly (
+	hour INTEGER NOT NULL,
+	channel INTEGER NOT NULL,
+	item TEXT NOT NULL,
+	outcome TEXT NOT NULL,
+	count INTEGER NOT NULL,
+	revenue REAL NOT NULL,
+	duration REAL NOT NULL,
+	PRIMARY KEY (hour, channel, item, outcome)
+);
+"""
+
+groups = {
+	"item": "item",
+	"channel": "channel",
+	"hour": "hour*3600",
+	"outcome": "outcome",
+}
+"""Columns sales totals can be grouped by."""
+
+max_sales = 1000
+"""Most sales returned by `Ledger.sales()` at once."""
+
+class Ledger():
+	def __init__(self, salesPath="", salesFile="sales.db"):
+		if os.path.isabs(salesFile):
+			self._salesFile = salesFile #file provided in configuration is already absolute
+		else:
+			self._salesFile = os.path.join(salesPath, salesFile) #combine with config directory
+		self._db = None
+
+	def open(self):
+		"""Connect to the ledger, if not already connected.
+
+		Called by `vendmachine.server.Server.run()`, as a connection can't be used across `os.fork()`.
+		"""
+		if self._db is not None:
+			return
+		print("Opening sales ledger '{}'".format(self._salesFile))
+		#green threads all run on one OS thread
+		self._db = sqlite3.connect(self._salesFile, check_same_thread=False)
+		with self._db:
+			self._db.executescript(schema)
+
+	def record(self, channel, item, price, outcome, duration, t=None):
+		"""Add a sale to the ledger and its hourly totals.
+
+		`outcome` is `"success"` or `"error"`. Only successful sales count towards revenue.
+		"""
+		if t is None:
+			t = time.time()
+		revenue = price if outcome == "success" else 0.0
+		hour = int(t // 3600)
+		with self._db:
+			self._db.execute("INSERT INTO sales (time, channel, item, price, outcome, duration) VALUES (?, ?, ?, ?, ?, ?)",
+			                 (t, channel, item, price, outcome, duration))
+			cursor = self._db.execute("UPDATE hourly SET count = count + 1, revenue = revenue + ?, duration = duration + ? "
+			                          "WHERE hour = ? AND channel = ? AND item = ? AND outcome = ?",
+			                          (revenue, duration, hour, channel, item, outcome))
+			if cursor.rowcount == 0:
+				self._db.execute("INSERT INTO hourly (hour, channel, item, outcome, count, revenue, duration) VALUES (?, ?, ?, ?, 1, ?, ?)",
+				                 (hour, channel, item, outcome, revenue, duration))
+
+	def sales(self, start=None, end=None, limit=100):
+		"""Return up to `limit` (at most `max_sales`) sales between `start` and `end` (UNIX times), newest first."""
+		limit = max(1, min(int(limit), max_sales)) #negative LIMIT is no limit at all
+		where, args = self._range("time", start, end)
+		rows = self._db.execute("SELECT time, channel, item, price, outcome, duration FROM sales {} "
+		                        "ORDER BY time DESC LIMIT ?".format(where), args + [limit])
+		return [{"time": t, "channel": channel, "item": item, "price": price, "outcome": outcome, "duration": duration}
+		        for (t, channel, item, price, outcome, duration) in rows]
+
+	def totals(self, group, start=None, end=None):
+		"""Return sale totals grouped by `group` (a key of `groups`) between `start` and `end`.
+
+		Totals come from the hourly rollup, so `start` and `end` are rounded down to the hour.
+		"""
+		if group not in groups:
+			raise ValueError("Unknown group '{}'".format(group))
+		where, args = self._range("hour", None if start is None else int(start // 3600),
+		                                  None if end is None else int(end // 3600))
+		rows = self._db.execute("SELECT {col}, SUM(count), SUM(CASE WHEN outcome = 'success' THEN count ELSE 0 END), "
+		                        "SUM(revenue), SUM(duration) FROM hourly {where} GROUP BY {col} ORDER BY {col}"
+		                        .format(col=groups[group], where=where), args)
+		return [{group: key, "count": count, "sold": sold, "revenue": revenue,
+		         "avgDuration": duration/count if count else 0.0}
+		        for (key, count, sold, revenue, duration) in rows]
+
+	def _range(self, column, start, end):
+		clauses = []
+		args = []
+		if start is not None:
+			clauses.append("{} >= ?".format(column))
+			args.append(start)
+		if end is not None:
+			clauses.append("{} < ?".format(column))
+			args.append(end)
+		return ("WHERE " + " AND ".join(clauses) if clauses else ""), args
+
+	def close(self):
+		if self._db is not None:
+			self._db.close()
+			self._db = None
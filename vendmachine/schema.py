@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+"""Validation of API request arguments.
+
+A `Schema` is made once per route, from the type of each argument the
+route takes. It checks and converts arguments from either a JSON body,
+where values already have types, or form and query arguments, where
+every value is a string to be parsed.
+"""
+
+def _float(value):
+	if isinstance(value, bool):
+		raise ValueError()
+	if isinstance(value, (int, float, str)):
+		return float(value)
+	raise ValueError()
+
+def _int(value):
+	if isinstance(value, bool):
+		raise ValueError()
+	if isinstance(value, int):
+		return value
+	if isinstance(value, float) and value.is_integer():
+		return int(value)
+	if isinstance(value, str):
+		return int(value)
+	raise ValueError()
+
+def _str(value):
+	if not isinstance(value, str):
+		raise ValueError()
+	return value
+
+def _bool(value):
+	if isinstance(value, bool):
+		return value
+	if isinstance(value, str) and value.lower() in ("true", "1", "on", "yes"):
+		return True
+	if isinstance(value, str) and value.lower() in ("false", "0", "off", "no", ""):
+		return False
+	raise ValueError()
+
+converters = {
+	float: _float,
+	int: _int,
+	str: _str,
+	bool: _bool,
+}
+"""Function checking and converting a JSON or string value to each supported type."""
+
+class Schema():
+	"""The arguments a route takes.
+
+	`fields`: Mapping of argument name to type (`str`, `int`, `float`, or `bool`).
+	`required`: Names of arguments which must be present.
+	`extra`: Whether to allow (and pass through unchanged) arguments not in `fields`.
+	"""
+	def __init__(self, fields, required=(), extra=False):
+		for name in required:
+			if name not in fields:
+				raise ValueError("Required argument '{}' has no type".format(name))
+		self._fields = [(name, converters[typ], name in required) for (name, typ) in fields.items()]
+		self._names = frozenset(fields)
+		self._extra = extra
+
+	def validate(self, values):
+		"""Return a dict of the arguments in `values`, converted to their types.
+
+		Raises `ValueError` describing the first missing or invalid argument.
+		"""
+		result = {}
+		for (name, convert, required) in self._fields:
+			if name not in values:
+				if required:
+					raise ValueError("Missing '{}' argument".format(name))
+				continue
+			try:
+				result[name] = convert(values[name])
+			except (ValueError, TypeError):
+				raise ValueError("Invalid '{}' argument".format(name))
+		for name in values:
+			if name not in self._names:
+				if not self._extra:
+					raise ValueError("Unknown argument '{}'".format(name))
+				result[name] = values[name]
+		return result
@@ -21,14 +21,21 @@ except ImportError:
 	raise ImportError("Unable to find Flask. Module must be run from up-to-date virtualenv.")
 
 from enum import IntEnum, unique
+import os
 import time
+import secrets
 import functools
+import sqlite3
 import eventlet
+import yaml
 
 eventlet.monkey_patch()
 
 from vendmachine.items import Items
 from vendmachine.users import Users
+from vendmachine import metrics, events
+from vendmachine.persist import Flusher
+from vendmachine.watch import FileWatcher
 
 @unique
 class Status(IntEnum):
@@ -64,23 +71,51 @@ class Server():
 	def __init__(self):
 		self._status = Status.Ready
 		self._credit = 0.0
+		self._epoch = secrets.token_hex(4) #distinguishes versions from before a restart
+		self._version = 0 #increased on every change to status or credit
+		self._modified = time.time()
+		self._catalog_version = None #catalog version last sent to clients
 		self.config = None
 		"""`vendmachine.config.Config` object containing all server settings."""
 		self.items = None
 		"""`vendmachine.items.Items` object managing vending machine inventory."""
 		self.users = None
 		"""`vendmachine.users.Users` object managing all authorized users."""
+		self.sales = None
+		"""`vendmachine.sales.Ledger` recording every vend. `None` if disabled."""
+		self.store = None
+		"""`vendmachine.storage.SqliteStorage` holding items and users.
+		`None` if they are stored in YAML files."""
+		self.flusher = None
+		"""`vendmachine.persist.Flusher` saving `Server.config`, `Server.items`, and `Server.users`
+		in the background. `None` if background saving is disabled."""
 		self.app = None
 		"""`flask.Flask` object containing the main Flask application."""
 		self.socketio = None
 		"""`flask_socketio.SocketIO` object containing the main socketio server.
 
 		Ultimately responsible for actually running the Flask app."""
+		self.broadcaster = None
+		"""`vendmachine.broadcast.StatusBroadcaster` sending status changes to clients."""
+		self.event_log = events.EventLog()
+		"""`vendmachine.events.EventLog` of recent events, replayed to resuming clients."""
+		self.vend_queue = None
+		"""`vendmachine.vendqueue.VendQueue` of vends waiting their turn."""
+		self.sessions = {}
+		"""Id of the user (`None` if anonymous) connected on each websocket session, by session id."""
+		self.heartbeat = None
+		"""`vendmachine.heartbeat.Heartbeat` measuring latency to each websocket client."""
+		self.limiter = None
+		"""`vendmachine.ratelimit.RateLimiter` throttling API clients."""
 		self.login_manager = LoginManager()
 		"""`flask_login.LoginManager` handling user sessions and authentication."""
 		self._host = None
 		self._port = None
 		self.machine = None
+		self._watcher = None
+		self.boot_times = []
+		"""List of `(phase, seconds)` pairs recording how long each part of `Server.setup()` took."""
+		self._boot_mark = None
 
 	def setup(self, config_dir=""):
 		"""Setup the Server's configurations, outputs, and Flask objects.
@@ -100,24 +135,57 @@ class Server():
 		- `Server.login_manager` as `flask_login.LoginManager`
 
 		"""
+		self._boot_mark = time.perf_counter()
 		from vendmachine.config import init
 		self.config = init(config_dir)
+		self._boot_phase("config")
 		print("Autosave {}".format("enabled" if self.config.get(["files", "autosave"]) else "disabled"))
-		self.items = Items(config_dir, self.config.get(["files", "items"]), self.config.get(["files", "autosave"]))
-		self.users = Users(config_dir, self.config.get(["files", "users"]), self.config.get(["files", "autosave"]))
+		backend = self.config.get(["files", "backend"])
+		print("Using {} storage".format(backend))
+		if backend == "sqlite":
+			from vendmachine.storage import SqliteStorage
+			self.store = SqliteStorage(config_dir, self.config.get(["files", "database"]))
+			self.store.migrate(os.path.join(config_dir, self.config.get(["files", "items"])),
+			                   os.path.join(config_dir, self.config.get(["files", "users"])))
+		elif backend != "yaml":
+			raise ValueError("Unknown storage backend '{}'".format(backend))
+		self._boot_phase("storage")
+		cache = self.config.get(["files", "cache"])
+		self.items = Items(config_dir, self.config.get(["files", "items"]), self.config.get(["files", "autosave"]),
+		                   journal=self.config.get(["files", "journal"]), compact=self.config.get(["files", "compact"]),
+		                   store=self.store, cache=cache)
+		self._catalog_version = self.items.version("items", "channels")[0]
+		self.items.subscribe(self._items_changed)
+		self._boot_phase("items")
+		self.users = Users(config_dir, self.config.get(["files", "users"]), self.config.get(["files", "autosave"]),
+		                   store=self.store, cache=cache)
+		self._boot_phase("users")
+		if self.config.get(["files", "sales"]):
+			from vendmachine.sales import Ledger
+			self.sales = Ledger(config_dir, self.config.get(["files", "sales"])) #opened by `Server.run()`
+		if self.config.get(["files", "background"]):
+			self.flusher = Flusher(self.config.get(["files", "flush_delay"]), self.config.get(["files", "flush_max_delay"]))
+			self.config.flusher = self.flusher
+			self.items.flusher = self.flusher
+			self.users.flusher = self.flusher
+		if self.config.get(["files", "watch"]):
+			if self.store is None:
+				self._watcher = FileWatcher(self.items.path(), self.reload_items, self.config.get(["files", "watch_interval"]))
+		self.config.subscribe(self._files_changed, ["files"])
 
 		secret_key = self.config.get(["server", "secretKey"])
 		if not secret_key:
 			print("Generating server key")
 			secret_key = secrets.token_urlsafe(32)
 			self.config.set(["server", "secretKey"], secret_key)
-			self.config.save()
+			self.config.dirty()
 		self.app = Flask("vendmachine")
 		self.app.secret_key = secret_key
 
 		self.login_manager.init_app(self.app)
 		from flask_socketio import SocketIO
 		self.socketio = SocketIO(self.app, logger=False, engineio_logger=True, async_mode='eventlet')
+		self._boot_phase("flask")
 
 		import vendmachine.routes
 		from vendmachine.api import api
@@ -125,9 +193,121 @@ class Server():
 		self.app.register_blueprint(api, url_prefix="/api") #subdomain="api"
 		self.app.register_blueprint(ext, url_prefix="/ext")
 		self.app.register_blueprint(api, url_prefix="/ext/api") #, auth=True
+		from vendmachine.auth import compile_policy
+		compile_policy(self.app)
+		self.config.subscribe(lambda config, keys: compile_policy(self.app), ["access"])
+		from vendmachine.ratelimit import RateLimiter
+		self.limiter = RateLimiter(self.config.get(["ratelimit"]))
+		self.config.subscribe(lambda config, keys: self.limiter.configure(config.get(["ratelimit"])), ["ratelimit"])
+
+		from vendmachine.broadcast import StatusBroadcaster
+		self.broadcaster = StatusBroadcaster(self, self.config.get(["server", "status_window"]))
+		self.config.subscribe(lambda config, keys: setattr(self.broadcaster, "window", config.get(["server", "status_window"])),
+		                      ["server", "status_window"])
+		self.event_log.size = self.config.get(["server", "event_buffer"])
+		from vendmachine.vendqueue import VendQueue
+		self.vend_queue = VendQueue(self, self.config.get(["server", "vend_queue"]))
+		self.config.subscribe(lambda config, keys: setattr(self.vend_queue, "size", config.get(["server", "vend_queue"])),
+		                      ["server", "vend_queue"])
+		from vendmachine.heartbeat import Heartbeat
+		self.heartbeat = Heartbeat(self, self.config.get(["server", "heartbeat_interval"]),
+		                           self.config.get(["server", "heartbeat_degraded"]))
+		if self.store is not None:
+			self.store.close() #reopened by `Server.run()`, as connections can't cross a fork
 
 		self._port = self.config.get(["server", "port"])
 		self._host = self.config.get(["server", "host"])
+		self._boot_phase("routes")
+		print(self.boot_report())
+
+	def _boot_phase(self, phase):
+		now = time.perf_counter()
+		self.boot_times.append((phase, now - self._boot_mark))
+		self._boot_mark = now
+
+	def boot_report(self):
+		"""Return a printable summary of `Server.boot_times`."""
+		total = sum(t for (phase, t) in self.boot_times)
+		lines = ["Startup took {:.3f} s:".format(total)]
+		for (phase, t) in self.boot_times:
+			lines.append("  {:<10} {:8.3f} s {:5.1f}%".format(phase, t, 100.0*t/total if total else 0.0))
+		return "\n".join(lines)
+
+	def _files_changed(self, config, keys):
+		autosave = config.get(["files", "autosave"])
+		self.items.autosave = autosave
+		self.users.autosave = autosave
+		if self.flusher is not None:
+			self.flusher.quiet = config.get(["files", "flush_delay"])
+			self.flusher.max_delay = config.get(["files", "flush_max_delay"])
+
+	def reload_items(self):
+		"""Apply edits made to the items file, and tell clients what changed.
+
+		Each changed item or channel is sent to clients as an `itemUpdate`,
+		`itemDelete`, `channelUpdate`, or `channelDelete` event.
+		"""
+		try:
+			changes = self.items.reload()
+		except (ValueError, KeyError, TypeError, yaml.YAMLError) as e:
+			print("Rejected changes to item list: {}".format(e))
+			return
+		for record in changes:
+			if record[0] == "item":
+				self.emit('itemUpdate', {"name": record[1], "item": record[2]})
+			elif record[0] == "del_item":
+				self.emit('itemDelete', {"name": record[1]})
+			elif record[0] == "channel":
+				self.emit('channelUpdate', {"number": record[1], "channel": record[2]})
+			elif record[0] == "del_channel":
+				self.emit('channelDelete', {"number": record[1]})
+
+	def _items_changed(self, records):
+		"""Send clients a `catalog` event with the catalog entries changed by `records`.
+
+		The event holds the `version` of the catalog after the change, the `base` version
+		it applies to, and the changed `channels` (`null` for removed channels).
+		Clients holding a different version, or receiving an event without `channels`,
+		should fetch the whole catalog again from `/api/catalog`.
+		"""
+		base = self._catalog_version
+		self._catalog_version = self.items.version("items", "channels")[0]
+		if self.socketio is None: #still starting up
+			return
+		channels = self.items.catalog_delta(records)
+		delta = {"base": base, "version": self._catalog_version}
+		if channels is not None:
+			delta["channels"] = channels
+		self.emit('catalog', delta)
+
+	def emit(self, event, data=None, room=None, **kwargs):
+		"""Send websocket event `event` to `room` (a topic or session), or else to the clients
+		subscribed to its topic (see `vendmachine.events`).
+		"""
+		metrics.socket_emits.inc(event)
+		if room is None:
+			room = events.topic(event)
+			metrics.topic_emits.inc(room or "all")
+			if room is not None and isinstance(data, dict): #number it, and keep it for resuming clients
+				data = dict(data, eventSeq=self.event_log.record(room, event, data), epoch=self.event_log.epoch)
+		else:
+			metrics.topic_emits.inc(room if room in events.topics else "session")
+		kwargs.setdefault("namespace", "/")
+		self.socketio.emit(event, data, room=room, **kwargs)
+
+	def snapshot(self, topic):
+		"""Return the `(event, data)` that brings a client up to date on `topic`,
+		or `None` if the topic has no state to catch up on.
+		"""
+		if topic == "status":
+			data = self.broadcaster.snapshot()
+		elif topic == "catalog": #no changes, so client fetches the whole catalog
+			data = {"base": None, "version": self._catalog_version}
+		else:
+			return None
+		data["eventSeq"] = self.event_log.seq
+		data["epoch"] = self.event_log.epoch
+		return topic, data
 
 	def status_data(self):
 		return {"status": {
@@ -155,6 +335,7 @@ class Server():
 		self.status_update()
 	def pulse_event(self):
 		print("Recording pulse")
+		metrics.pulses.inc()
 		self.add_credit(1.0)
 
 	def oos_event(self, value):
@@ -163,24 +344,64 @@ class Server():
 		else:
 			print("Bill acceptor back in service")
 
-	def status_update(self):
-		print("status {}, credit={}".format(str(self._status), self._credit))
-		self.socketio.emit('status', self.status_data(), namespace="/")
+	def version(self):
+		"""Return a tag that changes whenever status or credit change, along with the time
+		they were last changed.
 
-	def vend(self, channel):
+		Used for HTTP ETags and Last-Modified headers.
+		"""
+		return "{}-{}".format(self._epoch, self._version), self._modified
+
+	def status_update(self):
+		self._version += 1
+		self._modified = time.time()
+		if self.broadcaster is not None:
+			self.broadcaster.notify()
+
+	def vend(self, channel, sid=None):
+		"""Queue a vend from `channel`, taking its price from the credit.
+
+		Returns a `vendmachine.vendqueue.Ticket` for the vend. Progress and the result
+		are sent to websocket session `sid` if given. Raises `ValueError` if there isn't
+		enough credit, `RuntimeError` if the machine isn't ready, and
+		`vendmachine.vendqueue.QueueFull` if too many vends are already waiting.
+		"""
 		if channel not in self.items.channels():
 			raise KeyError("Channel not active")
-		motor = self.items.get_channel(channel)["motor"]
-		price = self.items.get_item(channel=channel)["price"]
-		if self._status != Status.Ready:
+		obj = self.items.get_channel(channel)
+		motor, item = obj.motor, obj.item
+		price = self.items.get_item(item)["price"]
+		if self._status == Status.NotReady:
 			raise RuntimeError("Not ready to vend")
 		if self._credit < price:
 			raise ValueError("Insufficient Credit")
+		ticket = self.vend_queue.submit(channel, motor, item, price, sid) #vended once this returns to the hub
 		self._credit -= price
-		self.status_change(Status.Vending)
-		self.socketio.start_background_task(self._vendTask, motor, price) #allows websocket to continue
+		if self._status == Status.Ready:
+			self.status_change(Status.Vending)
+		else:
+			self.status_update()
+		return ticket
+
+	def refund(self, amount):
+		"""Return `amount` to the credit, for a vend that failed or was cancelled (see `Server.vend_queue`)."""
+		self._credit += amount
+		self.status_update()
+
+	def queue_changed(self):
+		"""Called by `Server.vend_queue` after each vend, to return to `Ready` once it's empty."""
+		if not self.vend_queue.pending() and self._status == Status.Vending:
+			self.status_change(Status.Ready)
+
+	def _vendTask(self, channel, motor, item, price, sid=None):
+		"""Vend one `item`, run by `Server.vend_queue`. Returns the outcome and error message,
+		if any. The outcome is `"success"` once the motor has run, or else `"error"`,
+		meaning nothing was dispensed and the price should be refunded.
 
-	def _vendTask(self, motor, price):
+		`item` is looked up when the vend is requested, as the channel may change
+		(or be removed) before the vend finishes.
+		"""
+		start = time.monotonic()
 		try:
 			if self.machine is not None:
 				self.machine.vend(motor)
@@ -189,18 +410,56 @@ class Server():
 				eventlet.sleep(5)
 				print("Simulated vend done")
 			print("Vend Successful")
-			self.socketio.emit('vendSuccess', {})
+			outcome, message = "success", None
 		except Exception as e:
 			print("Vending error: {}".format(e))
-			self._credit += price
-			json = {"error": {
-			        "code": 1,
-			        "msg": str(e),
-			}}
-			self.socketio.emit('vendError', json)
-		self.status_change(Status.Ready)
+			outcome, message = "error", str(e)
+		duration = time.monotonic() - start
+		metrics.vends.inc(outcome)
+		metrics.vend_seconds.observe(duration, outcome)
+		try: #the motor has run (or not) either way, so nothing here changes the outcome
+			if outcome == "success":
+				self.emit('vendSuccess', {}, room=sid)
+			else:
+				json = {"error": {
+				        "code": 1,
+				        "msg": message,
+				}}
+				self.emit('vendError', json, room=sid)
+			self._record_sale(channel, item, price, outcome, duration)
+		except Exception as e:
+			print("Unable to record vend.\nError: {}".format(e))
+		return outcome, message
+
+	def _record_sale(self, channel, item, price, outcome, duration):
+		if outcome == "success":
+			obj = self.items.get_channel(channel)
+			if obj is not None and obj.item == item and obj.qty > 0:
+				self.items.update_channel(channel, qty=obj.qty - 1)
+		if self.sales is not None:
+			try:
+				self.sales.record(channel, item, price, outcome, duration)
+			except sqlite3.Error as e: #don't let bookkeeping break vending
+				print("Unable to record sale.\nError: {}".format(e))
 
 	def run(self):
+		"""Start the background workers and run the server until it's stopped.
+
+		Anything that can't survive `os.fork()` (database connections and green
+		threads) is started here rather than in `Server.setup()`.
+		"""
+		if self.store is not None:
+			self.store.open()
+		if self.sales is not None:
+			self.sales.open()
+		if self.flusher is not None:
+			self.flusher.start()
+		if self._watcher is not None:
+			self._watcher.start()
+		if self.config.get(["files", "watch"]):
+			self.config.watch(self.config.get(["files", "watch_interval"]))
+		self.vend_queue.start()
+		self.heartbeat.start()
 		try:
 			from RPi import GPIO
 			from vendmachine.machine import Machine
@@ -213,10 +472,26 @@ class Server():
 		self.socketio.run(self.app, debug=False, use_reloader=False, host=self._host, port=self._port)
 
 	def stop(self):
+		if self.broadcaster is not None:
+			self.broadcaster.stop()
+		if self.heartbeat is not None:
+			self.heartbeat.stop()
+		if self.vend_queue is not None:
+			self.vend_queue.stop()
+		if self._watcher is not None:
+			self._watcher.stop()
+		if self.config is not None:
+			self.config.unwatch()
+		if self.flusher is not None:
+			self.flusher.drain()
 		if self.users is not None:
 			self.users.exit()
 		if self.items is not None:
 			self.items.exit()
+		if self.store is not None:
+			self.store.close()
+		if self.sales is not None:
+			self.sales.close()
 		if self.config is not None:
 			#print("Saving config")
 			self.config.save()
@@ -225,7 +500,7 @@ class Server():
 			self.machine.stop()
 		if self.socketio is not None:
 			print("Sending socket shutdown")
-			self.socketio.emit('shutdown')
+			self.emit('shutdown')
 		#other things to do?
 
 def init_server():
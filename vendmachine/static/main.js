@@ -1,10 +1,43 @@
+var catalog = null; //channels with item, price, and qty, from /api/catalog
+function loadCatalog() {
+  $.ajax({
+    url: "/api/catalog",
+    error: function(xhr, status, text) {
+      console.log("Error getting catalog: " + xhr.status + text);
+      catalog = null; //look prices up from server instead
+    },
+    success: function(data) {
+      catalog = data.catalog;
+    }
+  });
+}
+socket.on('connect', function() {
+  if (catalog === null) loadCatalog(); //otherwise resuming replays missed changes
+});
+socket.on('catalog', function(data) {
+  seen(data);
+  if (catalog === null) return;
+  if (data.channels === undefined || data.base !== catalog.version) {
+    loadCatalog(); //out of date
+    return;
+  }
+  $.each(data.channels, function(channel, entry) {
+    if (entry === null)
+      delete catalog.channels[channel];
+    else
+      catalog.channels[channel] = entry;
+  });
+  catalog.version = data.version;
+});
+
 $(document).ready(function() {
   $('#vend-request').submit(function(e) {
     event.preventDefault(); //don't actually submit
     $.ajax({
       url: "/api/vend",
       method:"POST",
-      data:$(this).serialize(),
+      //send results of this vend to this page's websocket only
+      data:$(this).serialize() + (socket.id ? "&sid=" + encodeURIComponent(socket.id) : ""),
       error: function(xhr, status, text) {
       	switch (status) {
           case "timeout": break; //socket should handle connection messages
@@ -22,7 +55,7 @@ $(document).ready(function() {
               error("Vend address does not exist");
           break;
           case 402: error("Insufficient credit"); break;
-          case 409: error("Vending in progress"); break;
+          case 409: error(data.error !== undefined ? data.error : "Not ready to vend"); break;
           //returned when server is off but haproxy is working:
           case 503: error("Server unavailable"); break;
           default: error("Error requesting vend: " + xhr.status + text);
@@ -63,6 +96,19 @@ $(document).ready(function() {
         window.location.reload(true);
         return;
       }
+      if (catalog !== null) {
+        var entry = catalog.channels[parseInt($(this).val(), 10)];
+        if (entry === undefined) {
+          $(this).val("");
+          $(".price").html("");
+          price = null;
+        } else {
+          $(".price").html(entry.text);
+          price = entry.price;
+        }
+        oldVal = $(this).val();
+        return;
+      }
       $.ajax({
         url: "/api/channels/" + $(this).val() + "/price",
         error: function(xhr, status, text) {
@@ -93,6 +139,15 @@ $(document).ready(function() {
     }
     oldVal = $(this).val()
   });
+  function priceChanged(data) { //items file was edited, so look the entered channel up again
+    seen(data);
+    oldVal = "";
+    $('#vend-addr').change();
+  }
+  socket.on('itemUpdate', priceChanged);
+  socket.on('itemDelete', priceChanged);
+  socket.on('channelUpdate', priceChanged);
+  socket.on('channelDelete', priceChanged);
   $(document).on('click', function(e) {
     $('#vend-addr').delay(500).select(); //re-select vend address after click
   });
@@ -1,9 +1,25 @@
 var socket = io.connect('http://' + document.domain + ':' + location.port);
 var status = null;
+var statusData = null; //full status, kept up to date from partial broadcasts
+var statusSeq = null; //sequence number of last status received
+var eventSeq = null; //number of last topic event received, to resume from after reconnecting
+var epoch = null; //numbering eventSeq and statusSeq, which start over when the server restarts
 socket.on('connect', function() {
   $('.status').html("Connected")
-  socket.emit('status', {})
+  if (eventSeq === null)
+    socket.emit('status', {})
+  else
+    socket.emit('resume', {eventSeq: eventSeq, epoch: epoch}) //only send what was missed
 });
+function seen(data) {
+  if (data.epoch !== undefined && data.epoch !== epoch) { //server restarted
+    epoch = data.epoch;
+    eventSeq = null;
+    statusSeq = null;
+  }
+  if (data.eventSeq !== undefined && (eventSeq === null || data.eventSeq > eventSeq))
+    eventSeq = data.eventSeq;
+}
 socket.on('connect_error', function() {
   $('.status').html("Error connecting");
 });
@@ -13,7 +29,7 @@ socket.on('connect_timeout', function() {
 
 socket.on('disconnect', function() {
   $('.status').html("Disconnected");
-  status = null;
+  status = null; //statusData kept, to apply missed changes to on resuming
 });
 
 socket.on('status', function(data) {
@@ -22,9 +38,22 @@ socket.on('status', function(data) {
     return;
   }
   console.log("status: " + JSON.stringify(data.status));
-  status = data.status.code;
-  $('.status').html(data.status.text);
-  $('.credit').html(data.status.creditText);
+  seen(data);
+  if (data.partial) {
+    if (statusData === null || statusSeq === null || data.seq !== statusSeq + 1) {
+      if (statusSeq !== null && data.seq <= statusSeq) return; //already have it
+      socket.emit('status', {}); //missed a change, ask for everything
+      return;
+    }
+    $.extend(statusData, data.status);
+  } else {
+    if (statusSeq !== null && data.seq < statusSeq) return; //older than what we have
+    statusData = data.status;
+  }
+  statusSeq = data.seq;
+  status = statusData.code;
+  $('.status').html(statusData.text);
+  $('.credit').html(statusData.creditText);
 });
 /*window.setInterval(function(){
   socket.emit('status', {}); //if you want something done right...
@@ -43,6 +72,21 @@ socket.on('vendSuccess', function(data) {
   success("Vend Completed")
 });
 
+socket.on('ticket', function(data) {
+  console.log("socket(ticket): " + JSON.stringify(data));
+  switch (data.state) { //vendSuccess and vendError report the rest
+    case "queued":
+      if (data.position > 0)
+        info("Vend queued, " + data.position + " ahead");
+      break;
+    case "cancelled": info("Vend cancelled, credit refunded"); break;
+  }
+});
+
+socket.on('heartbeat', function(data, ack) {
+  if (ack !== undefined) ack(data); //server times the round trip
+});
+
 socket.on('refresh', function(msg) {
   window.location.reload(true);
 });
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+"""SQLite storage for `vendmachine.items.Items` and `vendmachine.users.Users`.
+
+Selected by setting `backend: sqlite` in the `files` section of `config.yaml`,
+along with the name of the database file in `database`. By default the
+stores are kept in YAML files instead.
+
+`Items` and `Users` still serve reads from memory. The database replaces
+whole-file rewrites: each change is written as a single row update, and
+changes saved together are committed in one transaction.
+
+The first time a database is used it is filled from the existing
+`items.yaml` and `users.yaml`, if present (see `SqliteStorage.migrate()`).
+This is recorded in the database's `user_version`, so it only ever happens once.
+"""
+
+import os
+import json
+import sqlite3
+
+from vendmachine.persist import load_yaml
+from vendmachine.users import User
+
+schema = """
+CREATE TABLE IF NOT EXISTS items (
+	name TEXT PRIMARY KEY,
+	price REAL NOT NULL,
+	data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS channels (
+	channel INTEGER PRIMARY KEY,
+	item TEXT NOT NULL,
+	motor INTEGER NOT NULL,
+	qty INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS channels_item ON channels (item);
+CREATE TABLE IF NOT EXISTS users (
+	name TEXT PRIMARY KEY,
+	data TEXT NOT NULL
+);
+"""
+
+migrated_version = 1
+"""`PRAGMA user_version` of a database that has been filled from the YAML files (or didn't need to be)."""
+
+class SqliteStorage():
+	def __init__(self, dbPath="", dbFile="vend.db"):
+		if os.path.isabs(dbFile):
+			self._dbFile = dbFile #file provided in configuration is already absolute
+		else:
+			self._dbFile = os.path.join(dbPath, dbFile) #combine with config directory
+		self._db = None
+		self.open()
+
+	def open(self):
+		"""Connect to the database, if not already connected.
+
+		A connection can't be used across `os.fork()`, so the server closes the
+		database after loading and opens it again once running.
+		"""
+		if self._db is not None:
+			return
+		print("Opening database '{}'".format(self._dbFile))
+		#green threads all run on one OS thread
+		self._db = sqlite3.connect(self._dbFile, check_same_thread=False)
+		with self._db:
+			self._db.executescript(schema)
+
+	def is_empty(self):
+		for table in ("items", "channels", "users"):
+			if self._db.execute("SELECT 1 FROM {} LIMIT 1".format(table)).fetchone() is not None:
+				return False
+		return True
+
+	def migrate(self, itemFile=None, usersFile=None):
+		"""Fill a new database from an items file and a users file.
+
+		Only done once for each database, even if everything in it is later
+		deleted. Returns whether anything was migrated.
+		"""
+		if self._db.execute("PRAGMA user_version").fetchone()[0] >= migrated_version:
+			return False
+		migrated = False
+		with self._db:
+			self._db.execute("PRAGMA user_version = {}".format(migrated_version))
+			if not self.is_empty(): #filled before migrations were recorded
+				return False
+			if itemFile is not None and os.path.isfile(itemFile):
+				print("Migrating item list from file '{}'".format(itemFile))
+				obj = load_yaml(itemFile) or {}
+				self._save_items(obj.get("items") or {}, obj.get("channels") or {})
+				migrated = True
+			if usersFile is not None and os.path.isfile(usersFile):
+				print("Migrating user list from file '{}'".format(usersFile))
+				users = [User(obj).to_dict() for obj in load_yaml(usersFile) or []] #hashes plaintext keys and passwords
+				self._save_users(users)
+				migrated = True
+		return migrated
+
+	def load_items(self):
+		items = {}
+		for name, data in self._db.execute("SELECT name, data FROM items"):
+			items[name] = json.loads(data)
+		channels = {}
+		for channel, item, motor, qty in self._db.execute("SELECT channel, item, motor, qty FROM channels"):
+			channels[channel] = {"item": item, "motor": motor, "qty": qty}
+		return {"items": items, "channels": channels}
+
+	def load_users(self):
+		return [json.loads(data) for (data,) in self._db.execute("SELECT data FROM users")]
+
+	def commit(self, records):
+		"""Apply change records (as passed to `Items.dirty()`/`Users.dirty()`) in one transaction."""
+		with self._db:
+			for record in records:
+				self._apply(record)
+
+	def _apply(self, record):
+		op, key = record[0], record[1]
+		if op == "item":
+			self._db.execute("INSERT OR REPLACE INTO items (name, price, data) VALUES (?, ?, ?)",
+			                 (key, record[2]["price"], json.dumps(record[2], default=str)))
+		elif op == "del_item":
+			self._db.execute("DELETE FROM items WHERE name = ?", (key,))
+		elif op == "channel":
+			channel = record[2]
+			self._db.execute("INSERT OR REPLACE INTO channels (channel, item, motor, qty) VALUES (?, ?, ?, ?)",
+			                 (int(key), channel["item"], channel["motor"], channel["qty"]))
+		elif op == "del_channel":
+			self._db.execute("DELETE FROM channels WHERE channel = ?", (int(key),))
+		elif op == "user":
+			self._db.execute("INSERT OR REPLACE INTO users (name, data) VALUES (?, ?)",
+			                 (key, json.dumps(record[2])))
+		elif op == "del_user":
+			self._db.execute("DELETE FROM users WHERE name = ?", (key,))
+		else:
+			raise ValueError("Unknown change record '{}'".format(op))
+
+	def save_items(self, items, channels):
+		"""Replace every item and channel in one transaction."""
+		with self._db:
+			self._save_items(items, channels)
+
+	def _save_items(self, items, channels):
+		self._db.execute("DELETE FROM items")
+		self._db.execute("DELETE FROM channels")
+		for name, item in items.items():
+			self._apply(("item", name, item))
+		for channel, obj in channels.items():
+			self._apply(("channel", channel, obj))
+
+	def _save_users(self, users):
+		self._db.execute("DELETE FROM users")
+		for user in users:
+			self._apply(("user", user["name"], user))
+
+	def close(self):
+		if self._db is not None:
+			self._db.close()
+			self._db = None
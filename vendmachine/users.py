@@ -1,19 +1,34 @@
 import os
 import yaml
 
+import hmac
 import hashlib
 import secrets
 
+from vendmachine.persist import load_yaml, save_yaml
+
 #this is a mess
 
 global api_user
 global anon_user
 
+def hash_apikey(apikey):
+	"""Return the digest of `apikey` stored in place of the key itself.
+
+	API keys are long and random, so they don't need salting like passwords.
+	"""
+	return hashlib.sha256(apikey.encode()).hexdigest()
+
 class Users():
-	def __init__(self, usersPath="", usersFile="users.yaml", autosave=True):
+	def __init__(self, usersPath="", usersFile="users.yaml", autosave=True, store=None, cache=False):
 		self.autosave = autosave
+		self._cache = cache #keep binary snapshot of users file
+		self.flusher = None #`vendmachine.persist.Flusher` to save in the background, if any
+		self._store = store #`vendmachine.storage.SqliteStorage` used in place of the users file, if any
 		self._dirty = False
+		self._changed = set() #uids added or deleted since last save to database
 		self._users = {}
+		self._apikeys = {} #index of uid for each API key digest
 		if os.path.isabs(usersFile):
 			self._usersFile = usersFile #file provided in configuration is already absolute
 		else:
@@ -21,23 +36,21 @@ class Users():
 		self.load()
 
 	def load(self):
-		if os.path.isfile(self._usersFile):
+		if self._store is not None:
+			print("Loading user list from database")
+			self._populate(self._store.load_users())
+			self.dirty(None)
+		elif os.path.isfile(self._usersFile):
 			print("Loading user list from file '{}'".format(self._usersFile))
 			try:
-				with open(self._usersFile, "r") as f:
-					try:
-						users = yaml.safe_load(f)
-					except yaml.YAMLError as e:
-						print("Invalid YAML File: '{}'".format(self._usersFile))
-						print("details: {}".format(e))
-						raise
-					for obj in users:
-						user = User(obj)
-						uid = user.get_id()
-						if uid in self._users:
-							raise ValueError("Username {} already in use".format(uid))
-						self._users[uid] = user
-					self.dirty(None)
+				try:
+					users = load_yaml(self._usersFile, self._cache)
+				except yaml.YAMLError as e:
+					print("Invalid YAML File: '{}'".format(self._usersFile))
+					print("details: {}".format(e))
+					raise
+				self._populate(users)
+				self.dirty(None) #hash any new passwords
 			except EnvironmentError as e:
 				print("Unable to open users file '{}'".format(self._usersFile))
 				raise
@@ -46,9 +59,30 @@ class Users():
 				raise EnvironmentError("Config path '{}' exists but is not a file".format(self._usersFile))
 			print("Creating user list")
 			self._users = {}
-			with open(self._usersFile, "w") as f:
-				yaml.safe_dump([], f)
+			save_yaml(self._usersFile, [], self._cache)
 			self.dirty()
+
+	def _populate(self, users):
+		for obj in users:
+			user = User(obj)
+			uid = user.get_id()
+			if uid in self._users:
+				raise ValueError("Username {} already in use".format(uid))
+			self._users[uid] = user
+			self._index(user)
+
+	def _index(self, user):
+		digest = user.apikey_hash()
+		if digest is None:
+			return
+		if digest in self._apikeys:
+			print("Warning: Users {} and {} share an API key".format(self._apikeys[digest], user.get_id()))
+		self._apikeys[digest] = user.get_id()
+
+	def _unindex(self, user):
+		digest = user.apikey_hash()
+		if digest is not None and self._apikeys.get(digest) == user.get_id():
+			del self._apikeys[digest]
 	
 	#def _gen_uid(self):
 		 #return 5
@@ -61,13 +95,35 @@ class Users():
 		if uid in self._users:
 			raise ValueError("UID {} already in use".format(uid))
 		self._users[uid] = user
+		self._index(user)
+		self._changed.add(uid)
 		self.dirty()
+
+	def find_apikey(self, apikey):
+		"""Return the user with `apikey`, or `None`.
+
+		Looks up the key's digest in an index, instead of checking each user.
+		"""
+		digest = hash_apikey(apikey)
+		uid = self._apikeys.get(digest)
+		if uid is None:
+			return None
+		user = self._users.get(uid)
+		if user is None or not user.check_apikey(apikey):
+			return None
+		return user
 	
 	def find(self, uid=None, name=None, apikey=None, admin=None, active=None):
 		if uid is not None:
 			user = self._users.get(uid)
-			if user.matches(name=name, apikey=apikey, admin=admin, active=active):
-				return [item]
+			if user is not None and user.matches(name=name, apikey=apikey, admin=admin, active=active):
+				return [user]
+			else:
+				return []
+		if apikey is not None:
+			user = self.find_apikey(apikey)
+			if user is not None and user.matches(name=name, admin=admin, active=active):
+				return [user]
 			else:
 				return []
 		matches = []
@@ -85,8 +141,9 @@ class Users():
 		return matches[0]
 	
 	def delete(self, uid):
-		del self._users[uid]
-		self._dirty = True
+		self._unindex(self._users.pop(uid))
+		self._changed.add(uid)
+		self.dirty()
 		
 	def dirty(self, dirty=True):
 		if dirty is None: #check to see if dirty
@@ -94,7 +151,35 @@ class Users():
 				return
 		self._dirty = True
 		if self.autosave:
-			self.save()
+			if self.flusher is not None:
+				self.flusher.notify(self)
+			else:
+				self.flush()
+
+	def flush(self):
+		if not self.is_dirty():
+			return
+		if self._store is None:
+			return self.save()
+		self._commit()
+
+	def _commit(self):
+		"""Commit the users added, changed, or deleted to the database, in one transaction."""
+		changed = self._changed | {uid for uid, user in self._users.items() if user.is_dirty()}
+		records = []
+		for uid in changed:
+			if uid in self._users:
+				records.append(("user", uid, self._users[uid].to_dict()))
+			else:
+				records.append(("del_user", uid))
+		self._store.commit(records)
+		self._clean()
+
+	def _clean(self):
+		self._dirty = False
+		self._changed = set()
+		for user in self._users.values():
+			user._dirty = False
 
 	def is_dirty(self):
 		if self._dirty:
@@ -105,7 +190,7 @@ class Users():
 		return False
 
 	def __len__(self):
-		return len(_users)
+		return len(self._users)
 
 	def __getitem__(self, uid):
 		return self._users[uid]
@@ -124,6 +209,10 @@ class Users():
 				pass
 
 	def save(self, usersFile=None):
+		if usersFile == None and self._store is not None:
+			print("Saving user list to database")
+			self._commit()
+			return
 		print("Saving user list")
 		if usersFile == None:
 			usersFile = self._usersFile
@@ -133,11 +222,9 @@ class Users():
 				raise EnvironmentError("Config path '{}' exists but is not a file".format(usersFile))
 			print("Saving user list to file '{}'".format(usersFile))
 		try:
-			with open(usersFile, "w") as f:
-				yaml.safe_dump([user.to_dict() for user in self._users.values()], f)
-			self._dirty = False
-			for user in self._users.values():
-				user._dirty = False
+			save_yaml(usersFile, [user.to_dict() for user in self._users.values()], self._cache and usersFile == self._usersFile)
+			if usersFile == self._usersFile:
+				self._clean()
 		except EnvironmentError as e:
 			print("Unable to save user list.\nError: {}".format(e))
 			raise
@@ -150,7 +237,10 @@ class User():
 		self._id = obj["name"]
 		self._active = bool(obj["active"]) if "active" in obj else True
 		self.is_admin = bool(obj["admin"]) if "admin" in obj else False
-		self._apikey = obj.get("apikey")
+		self._apikey_hash = obj.get("apikey_hash")
+		if obj.get("apikey") is not None: #plaintext key, only store digest
+			self._apikey_hash = hash_apikey(obj["apikey"])
+			self._dirty = True
 		if "password" not in obj:
 			print("No password for user `{}`. Disabling".format(name))
 			self._has_password = False
@@ -188,13 +278,17 @@ class User():
 		if self._has_password:
 			obj["password"] = self._password
 			obj["salt"] = self._salt
-		if self._apikey is not None:
-			obj["apikey"] = self._apikey
+		if self._apikey_hash is not None:
+			obj["apikey_hash"] = self._apikey_hash
 		return obj
+	def check_apikey(self, apikey):
+		if self._apikey_hash is None:
+			return False
+		return hmac.compare_digest(hash_apikey(apikey), self._apikey_hash)
 	def matches(self, name=None, admin=None, active=None, apikey=None):
-		if apikey is not None and self._apikey != apikey:
+		if apikey is not None and not self.check_apikey(apikey):
 			return False
-		if name is not None and self._name != name:
+		if name is not None and self._id != name:
 			return False
 		if admin is not None and self.is_admin != admin:
 			return False
@@ -203,8 +297,8 @@ class User():
 		return True
 	def is_dirty(self):
 		return self._dirty
-	def apikey(self):
-		return self._apikey
+	def apikey_hash(self):
+		return self._apikey_hash
 	def __eq__(self, other):
 		return self._id == other._id
 	#method required by flask_login:
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+"""Queue of vend requests, vended one at a time.
+
+Rather than turning away a vend while another is in progress, each
+request is checked, its price is taken from the credit straight away
+(so it can't be spent twice), and it is given a `Ticket` holding its
+place in the queue. A single worker green thread vends tickets in the
+order they were made.
+
+A ticket's progress is sent as `ticket` websocket events, to the
+session that asked for the vend if known (see `vendmachine.events`),
+and can be polled at `/api/vend/<ticket>`. Tickets still waiting can
+be cancelled, refunding their price.
+"""
+
+import time
+import secrets
+import collections
+import eventlet
+from eventlet.semaphore import Semaphore
+
+class QueueFull(Exception):
+	"""Raised when the queue already holds as many tickets as it allows."""
+
+class Ticket():
+	"""A single vend request, and how it turned out.
+
+	`state` is `queued`, `vending`, `success`, `error`, or `cancelled`.
+	"""
+	__slots__ = ("id", "channel", "motor", "item", "price", "sid", "state", "created", "finished", "error")
+
+	def __init__(self, channel, motor, item, price, sid=None):
+		self.id = secrets.token_hex(8)
+		self.channel = channel
+		self.motor = motor
+		self.item = item
+		self.price = price
+		self.sid = sid #websocket session to send events to
+		self.state = "queued"
+		self.created = time.time()
+		self.finished = None
+		self.error = None
+
+	def done(self):
+		return self.state in ("success", "error", "cancelled")
+
+class VendQueue():
+	def __init__(self, server, size=10, history=100):
+		self._server = server
+		self.size = size #most tickets waiting at once
+		self.history = history #finished tickets kept for polling
+		self._queue = collections.deque() #tickets waiting, in order
+		self._tickets = collections.OrderedDict() #every ticket kept, by id, oldest first
+		self._current = None #ticket being vended
+		self._ready = Semaphore(0) #released once per ticket queued
+		self._thread = None
+
+	def start(self):
+		if self._thread is None:
+			self._thread = eventlet.spawn(self._run)
+
+	def stop(self):
+		if self._thread is not None:
+			self._thread.kill()
+			self._thread = None
+
+	def submit(self, channel, motor, item, price, sid=None):
+		"""Queue a vend, whose `price` has already been taken from the credit.
+
+		Raises `QueueFull` if there's no room for it.
+		"""
+		if len(self._queue) >= self.size:
+			raise QueueFull("Vend queue is full")
+		ticket = Ticket(channel, motor, item, price, sid)
+		self._queue.append(ticket)
+		self._tickets[ticket.id] = ticket
+		self._trim()
+		self._notify(ticket)
+		self._ready.release()
+		return ticket
+
+	def get(self, id):
+		return self._tickets.get(id)
+
+	def cancel(self, id):
+		"""Cancel a queued ticket. Returns the ticket, or `None` if no ticket has `id`.
+
+		Raises `ValueError` if the ticket isn't waiting any more.
+		"""
+		ticket = self._tickets.get(id)
+		if ticket is None:
+			return None
+		if ticket.state != "queued":
+			raise ValueError("Ticket is already {}".format(ticket.state))
+		self._queue.remove(ticket)
+		self._finish(ticket, "cancelled")
+		self._server.refund(ticket.price)
+		self._positions()
+		return ticket
+
+	def position(self, ticket):
+		"""Return how many tickets will be vended before `ticket` (0 if next), or `None` if it isn't waiting."""
+		try:
+			return self._queue.index(ticket)
+		except ValueError:
+			return None
+
+	def __len__(self):
+		return len(self._queue)
+
+	def pending(self):
+		"""Return whether any ticket is waiting or being vended."""
+		return bool(self._queue) or self._current is not None
+
+	def to_dict(self, ticket):
+		obj = {
+			"ticket": ticket.id,
+			"channel": ticket.channel,
+			"item": ticket.item,
+			"price": ticket.price,
+			"state": ticket.state,
+			"position": self.position(ticket),
+			"created": ticket.created,
+			"finished": ticket.finished,
+		}
+		if ticket.error is not None:
+			obj["error"] = ticket.error
+		return obj
+
+	def _run(self):
+		while True:
+			self._ready.acquire()
+			if not self._queue: #cancelled
+				continue
+			ticket = self._current = self._queue.popleft()
+			ticket.state = "vending"
+			self._notify(ticket)
+			self._positions()
+			if ticket.channel not in self._server.items.channels(): #removed while waiting
+				outcome, ticket.error = "error", "Channel not active"
+				self._vendError(ticket)
+			else:
+				try:
+					outcome, ticket.error = self._server._vendTask(ticket.channel, ticket.motor, ticket.item, ticket.price, ticket.sid)
+				except Exception as e: #before the motor ran, as `_vendTask()` catches everything after
+					print("Error vending ticket {}: {}".format(ticket.id, e))
+					outcome, ticket.error = "error", str(e)
+					self._vendError(ticket)
+			if outcome == "error": #nothing dispensed
+				self._server.refund(ticket.price)
+			self._current = None
+			self._finish(ticket, outcome)
+			self._server.queue_changed()
+
+	def _finish(self, ticket, state):
+		ticket.state = state
+		ticket.finished = time.time()
+		self._notify(ticket)
+		self._trim()
+
+	def _positions(self):
+		for ticket in self._queue:
+			self._notify(ticket)
+
+	def _vendError(self, ticket):
+		"""Send `vendError` for a ticket failing before `_vendTask()` could send it."""
+		self._server.emit('vendError', {"error": {"code": 1, "msg": ticket.error}}, room=ticket.sid)
+
+	def _notify(self, ticket):
+		self._server.emit('ticket', self.to_dict(ticket), room=ticket.sid)
+
+	def _trim(self):
+		finished = sum(1 for ticket in self._tickets.values() if ticket.done())
+		for id in [id for (id, ticket) in self._tickets.items() if ticket.done()]:
+			if finished <= self.history:
+				break
+			del self._tickets[id]
+			finished -= 1
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+"""Watches files for changes made outside of the server.
+
+Uses inotify through the optional `inotify_simple` package where it is
+installed, and otherwise polls the file's modification time and size.
+"""
+
+import os
+import eventlet
+from eventlet.hubs import trampoline
+
+from vendmachine.persist import file_key
+
+try:
+	import inotify_simple
+except ImportError: #optional
+	inotify_simple = None
+
+class FileWatcher():
+	"""Calls `callback()` from a green thread whenever the file at `path` changes.
+
+	Without inotify, the file is checked every `interval` seconds.
+	Callbacks are also made for changes the server makes itself,
+	so `callback` should ignore files it has just written.
+	"""
+
+	def __init__(self, path, callback, interval=2.0):
+		self._path = os.path.abspath(path)
+		self._callback = callback
+		self.interval = interval
+		self._key = file_key(self._path)
+		self._thread = None
+
+	def start(self):
+		if self._thread is not None:
+			return
+		if inotify_simple is not None:
+			print("Watching '{}' with inotify".format(self._path))
+			self._thread = eventlet.spawn(self._run_inotify)
+		else:
+			print("Watching '{}' every {} s".format(self._path, self.interval))
+			self._thread = eventlet.spawn(self._run_poll)
+
+	def stop(self):
+		if self._thread is not None:
+			self._thread.kill()
+			self._thread = None
+
+	def check(self):
+		"""Call the callback if the file has changed since the last check."""
+		key = file_key(self._path)
+		if key == self._key:
+			return
+		self._key = key
+		if key is None: #removed, wait for it to come back
+			return
+		try:
+			self._callback()
+		except Exception as e: #keep watching
+			print("Error handling change to '{}': {}".format(self._path, e))
+
+	def _run_poll(self):
+		while True:
+			eventlet.sleep(self.interval)
+			self.check()
+
+	def _run_inotify(self):
+		inotify = inotify_simple.INotify()
+		flags = inotify_simple.flags
+		#watch directory, as saving replaces the file rather than writing to it
+		inotify.add_watch(os.path.dirname(self._path), flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE)
+		name = os.path.basename(self._path)
+		try:
+			while True:
+				trampoline(inotify.fd, read=True) #yield to other green threads until readable
+				if any(event.name == name for event in inotify.read(timeout=0)):
+					self.check()
+		finally:
+			inotify.close()